@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import threading
+
+from collections import OrderedDict
+
+from .cached_bucket import CacheNotFound
+
+
+#Ready-made stat dicts for getattr. A cached None means the path does not exist.
+#Entries are only dropped by invalidation, so every change to the directory
+#structure has to invalidate the paths it touches.
+class AttributeCache(object):
+    #Clients probe many names that never exist (".git", "desktop.ini", ...), so paths
+    #known to be missing are kept up to this count, least recently used are dropped first
+    MAX_MISSING = 10000
+
+    def __init__(self, max_missing=MAX_MISSING):
+        self._entries = {}
+
+        #Missing path -> None, least recently used first
+        self._missing = OrderedDict()
+        self.max_missing = max_missing
+
+        #Bumped on every invalidation, so attributes computed from an older directory
+        #structure by another thread are not stored
+        self.generation = 0
+        self._lock = threading.Lock()
+
+        #Counted without the lock, so they may be slightly off with several threads
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries) + len(self._missing)
+
+    def get(self, path):
+        try:
+            attributes = self._entries[path]
+        except KeyError:
+            with self._lock:
+                if path not in self._missing:
+                    self.misses += 1
+                    raise CacheNotFound()
+
+                attributes = self._missing[path] = self._missing.pop(path)
+
+        self.hits += 1
+        return attributes
+
+    def update(self, path, attributes, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+
+            if attributes is not None:
+                self._missing.pop(path, None)
+                self._entries[path] = attributes
+                return
+
+            self._entries.pop(path, None)
+            self._missing[path] = None
+            while len(self._missing) > self.max_missing:
+                del self._missing[next(iter(self._missing))]
+
+    def _remove(self, path):
+        self._entries.pop(path, None)
+        self._missing.pop(path, None)
+
+    def invalidate(self, path):
+        with self._lock:
+            self.generation += 1
+            self._remove(path)
+            self._remove(path + ".sha1")
+
+            #Parent directories may have been created or removed as well
+            while len(path) > 0:
+                path = path.rpartition("/")[0]
+                self._remove(path)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries = {}
+            self._missing = OrderedDict()
@@ -45,6 +45,22 @@ def create_parser():
     parser.set_defaults(use_disk=False)
     
     
+    parser.add_argument('--ranged_reads', dest='ranged_reads', action='store_true', help="Download only the blocks that are read from files opened read-only")
+    parser.set_defaults(ranged_reads=False)
+
+    parser.add_argument("--block_size", type=int, default=4 * 1024 * 1024, help="Block size in bytes for ranged reads and the block cache")
+    parser.add_argument("--max_blocks", type=int, default=8, help="Maximum number of blocks kept per open file for ranged reads")
+    parser.add_argument("--read_ahead_blocks", type=int, default=4, help="Maximum number of blocks fetched ahead of sequential ranged reads (0 to disable)")
+
+    parser.add_argument('--lazy_listing', dest='lazy_listing', action='store_true', help="List folders one at a time when they are visited instead of listing the whole bucket")
+    parser.set_defaults(lazy_listing=False)
+
+    parser.add_argument('--multithreaded', dest='multithreaded', action='store_true', help="Serve FUSE requests from several threads so independent files progress in parallel")
+    parser.set_defaults(multithreaded=False)
+
+    parser.add_argument('--write_back', dest='write_back', action='store_true', help="Upload files in the background after they are closed instead of blocking close")
+    parser.set_defaults(write_back=False)
+
     parser.add_argument('--debug', dest='debug', action='store_true')
     parser.set_defaults(debug=False)
 
@@ -68,6 +84,21 @@ def create_parser():
     )
 
     parser.add_argument("--temp_folder", type=str, default=".tmp/", help="Temporary file folder")
+    parser.add_argument("--cache_folder", type=str, default=None, help="Folder for a persistent block cache (disabled if not given)")
+    parser.add_argument("--state_folder", type=str, default=None, help="Folder for a snapshot of the bucket listing, loaded at mount time (disabled if not given)")
+    parser.add_argument("--cache_size", type=int, default=1024, help="Maximum size of the block cache in MB")
+    parser.add_argument("--memory_limit", type=int, default=None, help="Memory in MB for the buffers of all open files together, the least recently used parts are moved to --temp_folder over it (unlimited if not given)")
+    parser.add_argument("--large_file_threshold", type=int, default=200, help="Files of at least this size in MB are uploaded in parts (at least 10)")
+    parser.add_argument("--part_size", type=int, default=100, help="Part size in MB for uploads of large files (at least 5)")
+    parser.add_argument("--upload_threads", type=int, default=4, help="Number of parts of large files uploaded in parallel")
+    parser.add_argument("--download_threshold", type=int, default=100, help="Files of at least this size in MB are downloaded as several ranges in parallel")
+    parser.add_argument("--download_part_size", type=int, default=16, help="Range size in MB for parallel downloads")
+    parser.add_argument("--download_threads", type=int, default=4, help="Number of ranges downloaded in parallel")
+    parser.add_argument("--write_back_threads", type=int, default=4, help="Number of files uploaded in parallel with --write_back")
+    parser.add_argument("--write_back_queue", type=int, default=16, help="Maximum number of closed files waiting for upload with --write_back, closing more files blocks")
+    parser.add_argument("--upload_delay", type=float, default=None, help="Seconds a closed file waits for further changes before it is uploaded, implies --write_back (disabled if not given)")
+    parser.add_argument("--listing_timeout", type=int, default=120, help="Seconds a bucket listing is cached")
+    parser.add_argument("--listing_max_staleness", type=int, default=600, help="Seconds an expired listing is still served while it is refreshed in the background (0 to always wait for a new listing)")
     parser.add_argument("--config_filename", type=str, default="config.yaml", help="Config file")
 
     parser.add_argument('--allow_other', dest='allow_other', action='store_true')
@@ -116,16 +147,121 @@ def main():
     else:
         config["useDisk"] = False
 
+    if args.ranged_reads:
+        config["rangedReads"] = args.ranged_reads
+    else:
+        config["rangedReads"] = False
+
+    if args.block_size is not None:
+        config["blockSize"] = args.block_size
+
+    if args.max_blocks is not None:
+        config["maxBlocks"] = args.max_blocks
+
+    if args.read_ahead_blocks is not None:
+        config["readAheadBlocks"] = args.read_ahead_blocks
+
+    if args.lazy_listing:
+        config["lazyListing"] = args.lazy_listing
+    else:
+        config["lazyListing"] = False
+
+    if args.cache_folder:
+        config["cacheFolder"] = args.cache_folder
+
+    if args.state_folder:
+        config["stateFolder"] = args.state_folder
+
+    if args.cache_size is not None:
+        config["cacheSize"] = args.cache_size
+
+    if args.memory_limit is not None:
+        config["memoryLimit"] = args.memory_limit
+
+    if args.large_file_threshold is not None:
+        config["largeFileThreshold"] = args.large_file_threshold
+
+    if args.part_size is not None:
+        config["partSize"] = args.part_size
+
+    if args.upload_threads is not None:
+        config["uploadThreads"] = args.upload_threads
+
+    if args.download_threshold is not None:
+        config["downloadThreshold"] = args.download_threshold
+
+    if args.download_part_size is not None:
+        config["downloadPartSize"] = args.download_part_size
+
+    if args.download_threads is not None:
+        config["downloadThreads"] = args.download_threads
+
+    if args.write_back:
+        config["writeBack"] = args.write_back
+    else:
+        config["writeBack"] = False
+
+    if args.write_back_threads is not None:
+        config["writeBackThreads"] = args.write_back_threads
+
+    if args.write_back_queue is not None:
+        config["writeBackQueue"] = args.write_back_queue
+
+    if args.upload_delay is not None:
+        config["uploadDelay"] = args.upload_delay
+
+    if args.listing_timeout is not None:
+        config["listingTimeout"] = args.listing_timeout
+
+    if args.listing_max_staleness is not None:
+        config["listingMaxStaleness"] = args.listing_max_staleness
+
+    #B2 rejects parts under 5 MB, and a large file has at least two parts
+    if config["partSize"] < 5:
+        parser.error("--part_size must be at least 5 (MB)")
+
+    if config["largeFileThreshold"] < 10:
+        parser.error("--large_file_threshold must be at least 10 (MB)")
+
     args.options = {} # additional options passed to FUSE
 
     if args.allow_other:
         args.options['allow_other'] = True
 
+    if config.get("memoryLimit") is not None:
+        memory_limit = config["memoryLimit"] * 1024 * 1024
+    else:
+        memory_limit = None
+
     with B2Fuse(
         config["accountId"], config["applicationKey"], config["bucketId"],
-        config["enableHashfiles"], config["tempFolder"], config["useDisk"]
+        config["enableHashfiles"], config["tempFolder"], config["useDisk"],
+        ranged_reads=config["rangedReads"],
+        block_size=config["blockSize"],
+        max_blocks=config["maxBlocks"],
+        read_ahead_blocks=config["readAheadBlocks"],
+        cache_folder=config.get("cacheFolder"),
+        cache_size=config["cacheSize"] * 1024 * 1024,
+        memory_limit=memory_limit,
+        lazy_listing=config["lazyListing"],
+        large_file_threshold=config["largeFileThreshold"] * 1000 * 1000,
+        part_size=config["partSize"] * 1000 * 1000,
+        upload_threads=config["uploadThreads"],
+        download_threshold=config["downloadThreshold"] * 1000 * 1000,
+        download_part_size=config["downloadPartSize"] * 1000 * 1000,
+        download_threads=config["downloadThreads"],
+        write_back=config["writeBack"],
+        write_back_threads=config["writeBackThreads"],
+        write_back_queue=config["writeBackQueue"],
+        upload_delay=config.get("uploadDelay", 0),
+        state_folder=config.get("stateFolder"),
+        listing_timeout=config["listingTimeout"],
+        listing_max_staleness=config["listingMaxStaleness"]
     ) as filesystem:
-        FUSE(filesystem, args.mountpoint, nothreads=True, foreground=True, **args.options)
+        FUSE(
+            filesystem, args.mountpoint, nothreads=not args.multithreaded, foreground=True,
+            **args.options
+        )
 
 
 if __name__ == '__main__':
@@ -25,40 +25,111 @@
 
 import os
 import errno
+import functools
 import logging
 import shutil
+import threading
 
 from collections import defaultdict
+from concurrent import futures
 from fuse import FuseOSError, Operations
 from stat import S_IFDIR, S_IFREG
 from time import time
 
 from b2.account_info.in_memory import InMemoryAccountInfo
 from b2.api import B2Api
+from b2.b2http import B2Http
 
-from .filetypes.B2SequentialFileMemory import B2SequentialFileMemory
+from .filetypes.B2ChunkedFileMemory import B2ChunkedFileMemory
 from .filetypes.B2FileDisk import B2FileDisk
 from .filetypes.B2HashFile import B2HashFile
+from .filetypes.B2RangedFile import B2RangedFile
+from .filetypes.B2StatsFile import B2StatsFile
 from .directory_structure import DirectoryStructure
-from .cached_bucket import CachedBucket
+from .block_cache import BlockCache
+from .cached_bucket import CachedBucket, CacheNotFound
+from .attribute_cache import AttributeCache
+from .locking import PathLocks
+from .upload_queue import UploadQueue
+from .file_handles import HandleTable
+from .raw_api import B2FuseRawApi
+from .metadata_store import MetadataStore
+from .read_ahead import ReadAhead
+from .metrics import Metrics
+from .memory_budget import MemoryBudget
 
 
+#Serializes operations on the same path, operations on different paths run in parallel
+def path_locked(method):
+    @functools.wraps(method)
+    def wrapper(self, path, *args, **kwargs):
+        with self._path_locks.lock(self._remove_start_slash(path)):
+            return method(self, path, *args, **kwargs)
+
+    return wrapper
+
 
 class B2Fuse(Operations):
+    #Usage of a directory and everything below it, for du-like tools
+    USAGE_XATTRS = ("user.b2fuse.total_size", "user.b2fuse.total_files")
+
+    #Virtual folder with the metrics in the Prometheus text format
+    STATS_FOLDER = ".b2fuse"
+    STATS_FILE = ".b2fuse/stats"
+
+    #Suffix of the folder next to the temporary folder for files that could not be uploaded
+    #at unmount. The temporary folder itself is removed, and has to be gone at the next mount.
+    FAILED_UPLOADS_SUFFIX = "-failed_uploads"
+
+    #Listings overtaken by an upload or delete of this mount are fetched again this often
+    LISTING_ATTEMPTS = 3
+
     def __init__(
         self, account_id, application_key, bucket_id, enable_hashfiles, temp_folder,
-        use_disk
+        use_disk, ranged_reads=False, block_size=4 * 1024 * 1024, max_blocks=8,
+        cache_folder=None, cache_size=1024 * 1024 * 1024, lazy_listing=False,
+        large_file_threshold=200 * 1000 * 1000, part_size=100 * 1000 * 1000, upload_threads=4,
+        download_threshold=100 * 1000 * 1000, download_part_size=16 * 1000 * 1000,
+        download_threads=4, write_back=False, write_back_threads=4, write_back_queue=16,
+        state_folder=None, listing_timeout=120, listing_max_staleness=600, read_ahead_blocks=4,
+        b2_http=None, memory_limit=None, upload_delay=0
     ):
+        self.metrics = Metrics()
+        self.stats_snapshot = b""
+
+        #A stand-in for the HTTP layer, like FakeB2Http, runs b2fuse without a B2 account
+        if b2_http is None:
+            b2_http = B2Http()
+
         account_info = InMemoryAccountInfo()
-        self.api = B2Api(account_info)
+        self.api = B2Api(account_info, raw_api=B2FuseRawApi(b2_http, self.metrics))
         self.api.authorize_account('production', account_id, application_key)
-        self.bucket_api = CachedBucket(self.api, bucket_id)
+        self.bucket_api = CachedBucket(
+            self.api, bucket_id, large_file_threshold, part_size, upload_threads,
+            listing_timeout, listing_max_staleness
+        )
 
         self.logger = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
 
         self.enable_hashfiles = enable_hashfiles
         self.temp_folder = temp_folder
+        self.failed_uploads_folder = os.path.normpath(temp_folder) + self.FAILED_UPLOADS_SUFFIX
         self.use_disk = use_disk
+        self.ranged_reads = ranged_reads
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.read_ahead_blocks = read_ahead_blocks
+        self.lazy_listing = lazy_listing
+        self.download_threshold = download_threshold
+        self.download_part_size = download_part_size
+
+        #Shared by all open files, so the connection count stays bounded
+        self.download_pool = futures.ThreadPoolExecutor(max_workers=download_threads)
+
+        if cache_folder is not None:
+            self.block_cache = BlockCache(cache_folder, cache_size)
+        else:
+            self.block_cache = None
 
         if self.use_disk:
             if os.path.exists(self.temp_folder):
@@ -68,24 +139,114 @@ class B2Fuse(Operations):
             os.makedirs(self.temp_folder)
             self.B2File = B2FileDisk
         else:
-            self.B2File = B2SequentialFileMemory
+            #Chunks over the memory limit are spilled to files in the temporary folder
+            if memory_limit is not None and not os.path.exists(self.temp_folder):
+                os.makedirs(self.temp_folder)
+
+            self.B2File = B2ChunkedFileMemory
+
+        #Shared by the buffers of all open in-memory files
+        self.memory_budget = MemoryBudget(memory_limit)
 
         self._directories = DirectoryStructure()
         self.local_directories = []
 
-        self.open_files = defaultdict(self.B2File)
+        self._attributes = AttributeCache()
+
+        self.open_files = {}
+
+        #Every handle of a path shares its open file, which is released with the last handle
+        self._handles = HandleTable()
+
+        #Open files removed from their path while they still had handles -> whether to
+        #delete them online once the last handle is released
+        self._detached_files = {}
+
+        #Guards the local directory list
+        self._lock = threading.RLock()
+        self._path_locks = PathLocks()
+
+        #Waiting for further changes before uploading needs the uploads in the background
+        if write_back or upload_delay > 0:
+            self.upload_queue = UploadQueue(
+                self._upload_released_file, self._path_locks, write_back_threads,
+                write_back_queue, upload_delay
+            )
+        else:
+            self.upload_queue = None
+
+        #Full listings wait until the snapshot has been reconciled with the bucket
+        self._listing_ready = threading.Event()
+
+        if state_folder is not None:
+            self.metadata_store = MetadataStore(state_folder, bucket_id)
+            self._load_snapshot()
+        else:
+            self.metadata_store = None
+            self._listing_ready.set()
 
-        self.fd = 0
+        self._register_gauges()
+
+    def __call__(self, op, *args):
+        with self.metrics.timed("fuse_op", (("op", op), )):
+            return super(B2Fuse, self).__call__(op, *args)
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args, **kwargs):
+        if self.upload_queue is not None:
+            self.logger.info("Waiting for %s queued uploads", len(self.upload_queue))
+            self.upload_queue.close()
+
+        failed_paths = self._upload_remaining_files()
+
+        if self.metadata_store is not None:
+            self.metadata_store.save(self._directories.get_file_infos())
+
+        self.logger.info("Listing cache %s", self.bucket_api.get_cache_stats())
+
+        if self.block_cache is not None:
+            self.block_cache.close()
+
+        if len(failed_paths) > 0:
+            self.logger.error(
+                "Could not upload %s, kept in %s", ", ".join(failed_paths),
+                self.failed_uploads_folder
+            )
+
         if os.path.exists(self.temp_folder):
             shutil.rmtree(self.temp_folder)
 
         return
 
+    def _upload_remaining_files(self):
+        #Files whose upload failed, in the background or when they were closed, are still
+        #dirty. They get a last attempt, and are saved in the failed uploads folder if that
+        #fails too. Returns their paths.
+        failed_paths = []
+        for path, b2file in list(self.open_files.items()):
+            if not b2file.is_dirty():
+                continue
+
+            try:
+                b2file.upload()
+            except Exception:
+                self.logger.exception("Uploading %s at unmount failed", path)
+                self._save_failed_upload(path, b2file)
+                failed_paths.append(path)
+
+        return failed_paths
+
+    def _save_failed_upload(self, path, b2file):
+        filename = os.path.join(self.failed_uploads_folder, path)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        with open(filename, "wb") as f:
+            for offset in range(0, len(b2file), self.block_size):
+                f.write(b2file.read(offset, self.block_size))
+
     # Helper methods
     # ==================
 
@@ -104,44 +265,210 @@ class B2Fuse(Operations):
 
         return False
 
-    def _get_memory_consumption(self):
-        open_file_sizes = map(lambda f: len(f), self.open_files.values())
+    def _get_buffered_bytes(self):
+        return sum(len(open_file) for open_file in list(self.open_files.values()))
 
-        memory = sum(open_file_sizes)
+    def _get_cache_lookups(self):
+        listing_stats = self.bucket_api.get_cache_stats()
+
+        lookups = [
+            ("attributes", "hit", self._attributes.hits),
+            ("attributes", "miss", self._attributes.misses),
+            ("listings", "hit", listing_stats['hits']),
+            ("listings", "stale_hit", listing_stats['stale_hits']),
+            ("listings", "miss", listing_stats['misses']),
+        ]
+        if self.block_cache is not None:
+            lookups.append(("blocks", "hit", self.block_cache.hits))
+            lookups.append(("blocks", "miss", self.block_cache.misses))
+
+        return lookups
+
+    def _get_cache_hit_ratios(self):
+        totals = defaultdict(int)
+        hits = defaultdict(int)
+        for cache, result, count in self._get_cache_lookups():
+            totals[cache] += count
+            if result != "miss":
+                hits[cache] += count
+
+        return [
+            ((("cache", cache), ), float(hits[cache]) / totals[cache] if totals[cache] else 0.0)
+            for cache in sorted(totals)
+        ]
 
-        return float(memory) / (1024 * 1024)
+    def _register_gauges(self):
+        #Gauges are only computed when the stats file is read
+        self.metrics.register_gauge("open_files", lambda: len(self.open_files))
+        self.metrics.register_gauge("open_handles", lambda: len(self._handles))
+        self.metrics.register_gauge("buffered_bytes", self._get_buffered_bytes)
+        self.metrics.register_gauge("memory_bytes", lambda: len(self.memory_budget))
+        self.metrics.register_gauge("memory_spills", lambda: self.memory_budget.spills)
+        self.metrics.register_gauge("memory_reloads", lambda: self.memory_budget.reloads)
+        self.metrics.register_gauge(
+            "upload_queue_depth",
+            lambda: len(self.upload_queue) if self.upload_queue is not None else 0
+        )
+        self.metrics.register_gauge(
+            "uploads_coalesced",
+            lambda: self.upload_queue.coalesced if self.upload_queue is not None else 0
+        )
+        self.metrics.register_gauge(
+            "cache_lookups", lambda: [
+                ((("cache", cache), ("result", result)), count)
+                for cache, result, count in self._get_cache_lookups()
+            ]
+        )
+        self.metrics.register_gauge("cache_hit_ratio", self._get_cache_hit_ratios)
+        self.metrics.register_gauge(
+            "listing_refreshes", lambda: self.bucket_api.get_cache_stats()['refreshes']
+        )
 
-    def _get_cloud_space_consumption(self):
+    def _get_stats_attributes(self, path):
+        if path == self.STATS_FOLDER:
+            return dict(
+                st_mode=(S_IFDIR | 0o555),
+                st_ctime=time(),
+                st_mtime=time(),
+                st_atime=time(),
+                st_nlink=2
+            )
 
-        directories = [self._directories._directories]
+        #The size has to be known before the file is opened, so the snapshot is taken here
+        self.stats_snapshot = self.metrics.render().encode("utf-8")
+        return dict(
+            st_mode=(S_IFREG | 0o444),
+            st_ctime=time(),
+            st_mtime=time(),
+            st_atime=time(),
+            st_nlink=1,
+            st_size=len(self.stats_snapshot)
+        )
 
-        space_consumption = 0
-        while len(directories) > 0:
-            directory = directories.pop(0)
+    def _build_file_info_dict(self, file_info_object):
+        file_info = file_info_object.as_dict()
+        file_info["contentSha1"] = file_info_object.content_sha1
+        file_info["fileInfo"] = file_info_object.file_info
+        file_info["contentType"] = file_info_object.content_type
 
-            directories.extend(directory.get_directories())
+        #Upload responses do not always include the upload time
+        if "uploadTimestamp" not in file_info:
+            file_info["uploadTimestamp"] = int(time() * 1000)
 
-            for file_info in directory.get_file_infos():
-                space_consumption += file_info['size']
+        return file_info
 
-        return space_consumption
+    def _is_listing_current(self, generation):
+        #Checked with the directory structure locked, so changes that were not in the
+        #listing are not removed again by it
+        return lambda: self.bucket_api.get_cache_generation() == generation
 
     def _update_directory_structure(self):
-        #Update the directory structure with online files and local directories
-        def build_file_info_dict(file_info_object):
-            file_info = file_info_object.as_dict()
-            file_info["contentSha1"] = file_info_object.content_sha1
-            return file_info
-
-        online_files = [
-            build_file_info_dict(file_info_object)
-            for file_info_object, _ in self.bucket_api.ls()
-        ]
-        self._directories.update_structure(online_files, self.local_directories)
+        #Update the directory structure with online files, local directories are kept
+        for _ in range(self.LISTING_ATTEMPTS):
+            generation = self.bucket_api.get_cache_generation()
+            online_files = [
+                self._build_file_info_dict(file_info_object)
+                for file_info_object, _ in self.bucket_api.ls()
+            ]
+
+            changed_paths = self._directories.reconcile(
+                online_files, self._is_listing_current(generation)
+            )
+            if changed_paths is not None:
+                break
+        else:
+            self.logger.info("Bucket kept changing while listing, keeping the old listing")
+            return
+
+        for changed_path in changed_paths:
+            self._attributes.invalidate(changed_path)
+
+    def _load_snapshot(self):
+        #The last known listing is shown right away and checked against B2 in the background
+        self._directories.update_structure(self.metadata_store.load(), [])
+
+        if self.lazy_listing:
+            #Folders are reconciled one by one as they are listed
+            self._listing_ready.set()
+            return
+
+        thread = threading.Thread(target=self._reconcile_snapshot, name="reconcile-snapshot")
+        thread.daemon = True
+        thread.start()
+
+    def _reconcile_snapshot(self):
+        try:
+            self._update_directory_structure()
+            self.metadata_store.save(self._directories.get_file_infos())
+        except Exception:
+            self.logger.exception("Reconciling the metadata snapshot failed")
+        finally:
+            self._listing_ready.set()
+
+    def _list_directory(self, path):
+        #Update a single directory with the files and folders directly in it
+        for _ in range(self.LISTING_ATTEMPTS):
+            generation = self.bucket_api.get_cache_generation()
+
+            online_files = []
+            directory_names = []
+            for file_info_object, folder_name in self.bucket_api.ls(path, recursive=False):
+                if folder_name is None:
+                    online_files.append(self._build_file_info_dict(file_info_object))
+                else:
+                    directory_names.append(folder_name[:-1].rpartition("/")[2])
+
+            changed_paths = self._directories.update_directory(
+                path, online_files, directory_names, self._is_listing_current(generation)
+            )
+            if changed_paths is not None:
+                break
+        else:
+            self.logger.info("Bucket kept changing while listing %s, keeping the old listing", path)
+            return
+
+        for changed_path in changed_paths:
+            self._attributes.invalidate(changed_path)
+
+    def _ensure_listed(self, path):
+        #Lazily list the directories leading up to and including path
+        if self._directories.is_listed(path):
+            return
+
+        if len(path) > 0:
+            self._ensure_listed(path.rpartition("/")[0])
+
+        if self._directories.is_directory(path):
+            self._list_directory(path)
+
+    def _add_uploaded_file(self, file_info_object):
+        #Update the directory structure with a single uploaded file
+        file_info = self._build_file_info_dict(file_info_object)
+        self._directories.add_file(file_info)
+        self._attributes.invalidate(file_info['fileName'])
+
+        return file_info
 
     def _remove_local_file(self, path, delete_online=True):
+        if delete_online and self.block_cache is not None:
+            file_info = self._directories.get_file_info(path)
+            if file_info is not None:
+                self.block_cache.discard(file_info['fileId'])
+
         if path in self.open_files.keys():
-            self.open_files[path].delete(delete_online)
+            b2file = self.open_files[path]
+            if self.upload_queue is not None:
+                self.upload_queue.cancel(b2file)
+
+            #Files waiting for write-back may not have been uploaded yet
+            delete_online = delete_online and self._directories.is_file(path)
+
+            #Handles that are still open keep reading and writing the local copy
+            if self._handles.count(b2file) > 0:
+                self._detached_files[b2file] = delete_online
+            else:
+                b2file.delete(delete_online)
+
             del self.open_files[path]
         elif delete_online:
             file_info = self._directories.get_file_info(path)
@@ -150,6 +477,26 @@ class B2Fuse(Operations):
 
 #{u'contentType': u'application/octet-stream', u'contentSha1': u'a67ce81bd43149c12151e0a6cf1f40bc8571dfd7', u'contentLength': 19, u'fileName': u'.goutputstream-J5ZNPY', u'action': u'upload', u'fileInfo': {}, u'size': 19, u'uploadTimestamp': 1477072704000, u'fileId': u'4_z4a4089f903fbc1d150640114_f104e0f44e7832f51_d20161021_m175824_c001_v0001033_t0031'}
 
+    def _upload_released_file(self, path, b2file):
+        #Called from the upload queue with the path locked
+        if self.open_files.get(path) is not b2file:
+            return
+
+        b2file.upload()
+        self._remove_local_file(path, False)
+
+    def _get_open_file(self, path, fh):
+        #A handle keeps its file also after the path was unlinked or replaced
+        handle = self._handles.get(fh)
+        if handle is not None:
+            return handle.b2file
+
+        b2file = self.open_files.get(self._remove_start_slash(path))
+        if b2file is None:
+            raise FuseOSError(errno.EBADF)
+
+        return b2file
+
     def _remove_start_slash(self, path):
         if path.startswith("/"):
             path = path[1:]
@@ -180,9 +527,31 @@ class B2Fuse(Operations):
 
     def getattr(self, path, fh=None):
         self.logger.debug("Get attr %s", path)
-        self.logger.debug("Memory used %s", round(self._get_memory_consumption(), 2))
         path = self._remove_start_slash(path)
 
+        if path in (self.STATS_FOLDER, self.STATS_FILE):
+            return self._get_stats_attributes(path)
+
+        #Open files change size while they are written, so they are not cached
+        if path in self.open_files:
+            attributes = self._get_attributes(path)
+        else:
+            try:
+                attributes = self._attributes.get(path)
+            except CacheNotFound:
+                if self.lazy_listing:
+                    self._ensure_listed(path.rpartition("/")[0])
+
+                generation = self._attributes.generation
+                attributes = self._get_attributes(path)
+                self._attributes.update(path, attributes, generation)
+
+        if attributes is None:
+            raise FuseOSError(errno.ENOENT)
+
+        return attributes
+
+    def _get_attributes(self, path):
         #Check if path is a directory
         if self._directories.is_directory(path):
             return dict(
@@ -197,11 +566,17 @@ class B2Fuse(Operations):
         elif self._exists(path):
             #If file exist return attributes
 
-            online_files = [l[0].file_name for l in self.bucket_api.ls()]
+            file_info = self._directories.get_file_info(path)
+
+            #Looked up once, the file may be released by another thread at any time
+            open_file = self.open_files.get(path)
 
-            if path in online_files:
+            if file_info is not None:
                 #print "File is in bucket"
-                file_info = self._directories.get_file_info(path)
+                if open_file is not None:
+                    size = len(open_file)
+                else:
+                    size = file_info['size']
 
                 seconds_since_jan1_1970 = int(file_info['uploadTimestamp']/1000.)
                 return dict(
@@ -210,7 +585,7 @@ class B2Fuse(Operations):
                     st_mtime=seconds_since_jan1_1970,
                     st_atime=seconds_since_jan1_1970,
                     st_nlink=1,
-                    st_size=file_info['size']
+                    st_size=size
                 )
 
             elif path.endswith(".sha1"):
@@ -224,7 +599,7 @@ class B2Fuse(Operations):
                     st_size=42
                 )
 
-            else:
+            elif open_file is not None:
                 #print "File exists only locally"
                 return dict(
                     st_mode=(S_IFREG | 0o777),
@@ -232,16 +607,22 @@ class B2Fuse(Operations):
                     st_mtime=0,
                     st_atime=0,
                     st_nlink=1,
-                    st_size=len(self.open_files[path])
+                    st_size=len(open_file)
                 )
 
-        raise FuseOSError(errno.ENOENT)
+        return None
 
     def readdir(self, path, fh):
         self.logger.debug("Readdir %s", path)
         path = self._remove_start_slash(path)
 
-        self._update_directory_structure()
+        if path == self.STATS_FOLDER:
+            return ['.', '..', self.STATS_FILE.rpartition("/")[2]]
+
+        if self.lazy_listing:
+            self._list_directory(path)
+        elif self._listing_ready.is_set():
+            self._update_directory_structure()
 
         dirents = []
 
@@ -264,7 +645,7 @@ class B2Fuse(Operations):
         dirents.extend(online_files)
 
         #Add files kept in local memory
-        for filename in self.open_files.keys():
+        for filename in list(self.open_files.keys()):
             #File already listed
             if filename in dirents:
                 continue
@@ -298,6 +679,7 @@ class B2Fuse(Operations):
         )
         return dirents
 
+    @path_locked
     def rmdir(self, path):
         self.logger.debug("Rmdir %s", path)
         path = self._remove_start_slash(path)
@@ -312,11 +694,14 @@ class B2Fuse(Operations):
             return False
 
         #Add files found in bucket
-        online_files = [l[0].file_name for l in self.bucket_api.ls()]
-        dirents = filter(in_folder, online_files)
+        directory = self._directories.get_directory(path)
+        if directory is not None:
+            dirents = [file_info['fileName'] for file_info in directory.get_file_infos()]
+        else:
+            dirents = []
 
         #Add files kept in local memory
-        for filename in self.open_files.keys():
+        for filename in list(self.open_files.keys()):
             #File already listed
             if filename in dirents:
                 continue
@@ -332,31 +717,39 @@ class B2Fuse(Operations):
             dirents.append(filename)
 
         for filename in dirents:
-            online_files = [(l[0].file_name, l[0].id_) for l in self.bucket_api.ls()]
-            fileName_to_fileId = dict(online_files)
-            self.api.delete_file_version(fileName_to_fileId[path], path)
-
-            self._remove_local_file(filename)
+            with self._path_locks.lock(filename):
+                self._remove_local_file(filename)
+                self._directories.remove_file(filename)
 
         if self._directories.is_directory(path):
-            if path in self.local_directories:
-                i = self.local_directories.index(path)
-                self.local_directories.pop(i)
+            with self._lock:
+                if path in self.local_directories:
+                    i = self.local_directories.index(path)
+                    self.local_directories.pop(i)
+
+            self._directories.remove_directory(path)
+
+        #Folders that only existed through their files are gone from the directory
+        #structure by now, but their attributes and those of their files are still cached
+        self._attributes.clear()
 
     def mkdir(self, path, mode):
         self.logger.debug("Mkdir %s (mode:%s)", path, mode)
         path = self._remove_start_slash(path)
 
-        self.local_directories.append(path)
+        with self._lock:
+            self.local_directories.append(path)
 
-        self._update_directory_structure()
+        self._directories.add_directory(path)
+        self._attributes.invalidate(path)
 
     def statfs(self, path):
         self.logger.debug("Fetching file system stats %s", path)
         #Returns 1 petabyte free space, arbitrary number
         block_size = 4096 * 16
         total_block_count = 1024**4  #1 Petabyte
-        free_block_count = total_block_count - self._get_cloud_space_consumption() // block_size
+        space_consumption, _ = self._directories.get_usage("")
+        free_block_count = total_block_count - space_consumption // block_size
         return dict(
             f_bsize=block_size,
             f_blocks=total_block_count,
@@ -364,6 +757,24 @@ class B2Fuse(Operations):
             f_bavail=free_block_count
         )
 
+    def getxattr(self, path, name, position=0):
+        path = self._remove_start_slash(path)
+
+        usage = self._directories.get_usage(path)
+        if usage is None or name not in self.USAGE_XATTRS:
+            raise FuseOSError(errno.ENODATA)
+
+        return str(usage[self.USAGE_XATTRS.index(name)]).encode("utf-8")
+
+    def listxattr(self, path):
+        path = self._remove_start_slash(path)
+
+        if self._directories.is_directory(path):
+            return list(self.USAGE_XATTRS)
+
+        return []
+
+    @path_locked
     def unlink(self, path):
         self.logger.debug("Unlink %s", path)
         path = self._remove_start_slash(path)
@@ -373,7 +784,8 @@ class B2Fuse(Operations):
 
         self._remove_local_file(path)
 
-        self._update_directory_structure()
+        self._directories.remove_file(path)
+        self._attributes.invalidate(path)
 
     def rename(self, old, new):
         self.logger.debug("Rename old: %s, new %s", old, new)
@@ -381,22 +793,177 @@ class B2Fuse(Operations):
         old = self._remove_start_slash(old)
         new = self._remove_start_slash(new)
 
-        if not self._exists(old):
-            raise FuseOSError(errno.ENOENT)
+        with self._path_locks.lock(old, new):
+            if self._directories.is_directory(old):
+                self._rename_directory(old, new)
+                return
 
-        if self._exists(new):
-            self.unlink(new)
+            if not self._exists(old, include_hash=False):
+                raise FuseOSError(errno.ENOENT)
 
-        self.open(old, 0)
-        file_size = len(self.open_files[old])
-        data = self.open_files[old].read(0, file_size)
-        self.release(old, 0)
+            if self._exists(new):
+                self.unlink(new)
 
-        self.create(new, 0)
-        self.write(new, data, 0, 0)
-        self.release(new, 0)
+            b2file = self.open_files.get(old)
+            if b2file is not None and b2file.is_dirty():
+                self._upload_renamed_file(old, new, b2file)
+            else:
+                b2file = self._upload_open_file(old)
+                file_info = self._add_uploaded_file(self._copy_file(old, new))
+                if b2file is not None:
+                    self._move_open_file(old, new, b2file, file_info)
+
+            self.unlink(old)
+
+            #Deleting the latest version brings back the one before it, a renamed file
+            #keeps no versions under its old name
+            for file_version_info in list(self.bucket_api.ls_versions(old)):
+                if file_version_info.file_name == old:
+                    self.bucket_api.delete_file_version(file_version_info.id_, old)
+
+    def _upload_open_file(self, path):
+        #Local changes have to be online before the file can be copied. Returns the
+        #file if handles still have it open.
+        b2file = self.open_files.get(path)
+        if b2file is None:
+            return None
+
+        b2file.upload()
+        if self._handles.count(b2file) == 0:
+            self._remove_local_file(path, False)
+            return None
+
+        return b2file
+
+    def _upload_renamed_file(self, old, new, b2file):
+        #Local changes are uploaded straight to the new name. Uploaded to the old name
+        #and copied, deleting the old name would only remove the version just uploaded.
+        self._move_open_file(old, new, b2file, dict(b2file.file_info, fileName=new))
+        self._upload_open_file(new)
+
+    def _move_open_file(self, old, new, b2file, file_info):
+        #Writes through handles opened before the rename end up in the new file
+        if self.open_files.get(old) is not b2file:
+            return
+
+        del self.open_files[old]
+        b2file.rename(file_info)
+        self.open_files[new] = b2file
+        self._handles.rename(b2file, new)
+
+    def _copy_file(self, old, new):
+        #B2 copies the file server-side, its data is not transferred
+        file_info = self._directories.get_file_info(old)
+        return self.bucket_api.copy_file(
+            file_info['fileId'], new, file_info['size'], file_info.get('fileInfo'),
+            file_info.get('contentType')
+        )
+
+    def _rename_directory(self, old, new):
+        if self._exists(new, include_hash=False):
+            raise FuseOSError(errno.ENOTDIR)
+
+        if self.lazy_listing and self._directories.is_directory(new):
+            self._list_directory(new)
+
+        directory = self._directories.get_directory(new)
+        if directory is not None and not directory.is_empty():
+            raise FuseOSError(errno.ENOTEMPTY)
+
+        prefix = old + "/"
+        still_open = {}
+        uploaded = set()
+        for path in list(self.open_files.keys()):
+            if path.startswith(prefix) and not path.endswith(".sha1"):
+                new_path = new + path[len(old):]
+                with self._path_locks.lock(path, new_path):
+                    b2file = self.open_files.get(path)
+                    if b2file is not None and b2file.is_dirty():
+                        self._upload_renamed_file(path, new_path, b2file)
+                        uploaded.add(path)
+                        continue
+
+                    b2file = self._upload_open_file(path)
+                    if b2file is not None:
+                        still_open[path] = b2file
+
+        #The whole subtree is copied as one batch, including folders that were not listed yet.
+        #Files uploaded to the new name already only have their old version deleted.
+        file_info_objects = []
+        copied = []
+        for file_info_object, _ in self.bucket_api.ls(old, recursive=True):
+            if file_info_object.file_name in uploaded:
+                copied.append(file_info_object)
+            else:
+                file_info_objects.append(file_info_object)
+
+        with futures.ThreadPoolExecutor(max_workers=self.bucket_api.upload_threads) as pool:
+            copy_futures = [
+                pool.submit(
+                    self.bucket_api.copy_file, file_info_object.id_,
+                    new + file_info_object.file_name[len(old):], file_info_object.size,
+                    file_info_object.file_info, file_info_object.content_type
+                ) for file_info_object in file_info_objects
+            ]
+            futures.wait(copy_futures)
+
+            #Files that were copied are kept, the old directory is left as it was on errors
+            for file_info_object, copy_future in zip(file_info_objects, copy_futures):
+                if copy_future.exception() is None:
+                    file_info = self._build_file_info_dict(copy_future.result())
+                    self._directories.add_file(file_info)
+                    copied.append(file_info_object)
+
+                    old_path = file_info_object.file_name
+                    if old_path in still_open:
+                        with self._path_locks.lock(old_path, file_info['fileName']):
+                            self._move_open_file(
+                                old_path, file_info['fileName'], still_open[old_path], file_info
+                            )
+
+            for copy_future in copy_futures:
+                copy_future.result()
+
+            #Every version of the copied files is deleted, older ones would come back otherwise
+            copied_names = set(file_info_object.file_name for file_info_object in copied)
+            delete_futures = [
+                pool.submit(
+                    self.bucket_api.delete_file_version, file_version_info.id_,
+                    file_version_info.file_name
+                ) for file_version_info in self.bucket_api.ls_versions(prefix)
+                if file_version_info.file_name in copied_names
+            ]
+            futures.wait(delete_futures)
 
-        self.unlink(old)
+        for file_info_object in copied:
+            self._directories.remove_file(file_info_object.file_name)
+            if self.block_cache is not None:
+                self.block_cache.discard(file_info_object.id_)
+
+        for delete_future in delete_futures:
+            delete_future.result()
+
+        #Local directories move along with the files
+        with self._lock:
+            moved_directories = [
+                directory for directory in self.local_directories
+                if directory == old or directory.startswith(prefix)
+            ]
+            for directory in moved_directories:
+                self.local_directories.remove(directory)
+                if new + directory[len(old):] not in self.local_directories:
+                    self.local_directories.append(new + directory[len(old):])
+
+        for directory in moved_directories:
+            self._directories.add_directory(new + directory[len(old):])
+
+        self._directories.remove_directory(old)
+        if not self._directories.is_directory(new):
+            self._directories.add_directory(new)
+            with self._lock:
+                self.local_directories.append(new)
+
+        self._attributes.clear()
 
     def utimens(self, path, times=None):
         self.logger.debug("Utimens %s", path)
@@ -404,24 +971,51 @@ class B2Fuse(Operations):
     # File methods
     # ============
 
+    @path_locked
     def open(self, path, flags):
         self.logger.debug("Open %s (flags:%s)", path, flags)
         path = self._remove_start_slash(path)
 
+        if path == self.STATS_FILE:
+            if flags & os.O_ACCMODE != os.O_RDONLY:
+                raise FuseOSError(errno.EACCES)
+
+            self.open_files[path] = B2StatsFile(self, {'fileName': path})
+            return self._handles.add(path, self.open_files[path])
+
         if not self._exists(path):
             raise FuseOSError(errno.EACCES)
 
         if path.endswith(".sha1"):
-            file_info = self._directories.get_file_info(path[:-5])
-            self.open_files[path] = B2HashFile(self, file_info)
+            #Files that only exist locally are not in the directory structure yet
+            file_info = self._directories.get_file_info(path[:-5]) or {'fileName': path[:-5]}
+
+            with self._path_locks.lock(path[:-5]):
+                self.open_files[path] = B2HashFile(self, file_info)
 
-        elif self.open_files.get(path) is None:
+        elif self.open_files.get(path) is not None:
+            #A reopened file stays local until it is released again
+            if self.upload_queue is not None:
+                self.upload_queue.cancel(self.open_files[path])
+
+        else:
             file_info = self._directories.get_file_info(path)
-            self.open_files[path] = self.B2File(self, file_info)
 
-        self.fd += 1
-        return self.fd
+            #Files opened for reading only are fetched block by block
+            if self.ranged_reads and flags & os.O_ACCMODE == os.O_RDONLY:
+                self.open_files[path] = B2RangedFile(self, file_info)
+            else:
+                self.open_files[path] = self.B2File(self, file_info)
+
+        #Every handle follows its own read pattern
+        if self.read_ahead_blocks > 0 and isinstance(self.open_files[path], B2RangedFile):
+            read_ahead = ReadAhead(self.block_size, self.read_ahead_blocks * self.block_size)
+        else:
+            read_ahead = None
 
+        return self._handles.add(path, self.open_files[path], read_ahead)
+
+    @path_locked
     def create(self, path, mode, fi=None):
         self.logger.debug("Create %s (mode:%s)", path, mode)
 
@@ -432,38 +1026,84 @@ class B2Fuse(Operations):
 
         self.open_files[path] = self.B2File(self, file_info, True)
 
-        self.fd += 1
-        return self.fd
+        return self._handles.add(path, self.open_files[path])
 
+    @path_locked
     def read(self, path, length, offset, fh):
         self.logger.debug("Read %s (len:%s offset:%s fh:%s)", path, length, offset, fh)
 
-        return self.open_files[self._remove_start_slash(path)].read(offset, length)
+        b2file = self._get_open_file(path, fh)
+        data = b2file.read(offset, length)
+
+        #Sequential reads fetch the following blocks in the background
+        handle = self._handles.get(fh)
+        if handle is not None and handle.read_ahead is not None:
+            window = handle.read_ahead.record(offset, len(data))
+            if window > 0:
+                b2file.prefetch(offset + len(data), window)
 
+        return data
+
+    @path_locked
     def write(self, path, data, offset, fh):
-        path = self._remove_start_slash(path)
+        b2file = self._get_open_file(path, fh)
 
-        self.open_files[path].set_dirty(True)
-        self.open_files[path].write(offset, data)
+        b2file.set_dirty(True)
+        b2file.write(offset, data)
 
         return len(data)
 
+    @path_locked
     def truncate(self, path, length, fh=None):
         self.logger.debug("Truncate %s (%s)", path, length)
 
-        path = self._remove_start_slash(path)
-        self.open_files[path].set_dirty(True)
-        self.open_files[path].truncate(length)
+        b2file = self._get_open_file(path, fh)
+        b2file.set_dirty(True)
+        b2file.truncate(length)
 
+    @path_locked
     def flush(self, path, fh):
         self.logger.debug("Flush %s %s", path, fh)
 
-        self.open_files[self._remove_start_slash(path)].upload()
+        b2file = self._get_open_file(path, fh)
+
+        #With write-back files are uploaded after they are released, and files that were
+        #unlinked while open are not uploaded at all
+        if self.upload_queue is None and b2file not in self._detached_files:
+            b2file.upload()
+
+    @path_locked
+    def fsync(self, path, datasync, fh):
+        self.logger.debug("Fsync %s %s", path, fh)
 
+        b2file = self._get_open_file(path, fh)
+
+        #Uploads right away, also when uploads are left to the upload queue
+        if b2file not in self._detached_files:
+            b2file.upload()
+
+    @path_locked
     def release(self, path, fh):
         self.logger.debug("Release %s %s", path, fh)
+        path = self._remove_start_slash(path)
+
+        handle, remaining = self._handles.remove(fh)
+        if handle is None or remaining > 0:
+            #Other handles still use the file
+            return
+
+        b2file = handle.b2file
+        if self.open_files.get(path) is not b2file:
+            #The file was unlinked or replaced while it was open
+            b2file.delete(self._detached_files.pop(b2file, False))
+            return
+
+        if self.upload_queue is not None and b2file.is_dirty():
+            #The file stays open, and readable, until it has been uploaded
+            self.upload_queue.submit(path, b2file)
+            return
 
         self.logger.debug("Flushing file in case it was dirty")
-        self.flush(self._remove_start_slash(path), fh)
+        self.flush(path, fh)
 
         self._remove_local_file(path, False)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+
+from contextlib import contextmanager
+from timeit import default_timer
+
+from .b2fuse_main import B2Fuse
+from .fake_b2 import FakeB2Http
+
+BUCKET_ID = "benchmark"
+
+FILES_PER_FOLDER = 1000
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of B2Fuse operations against an in-process fake of B2"
+    )
+
+    parser.add_argument("--objects", type=int, nargs="+", default=[1000, 10000, 100000], help="Bucket sizes for the metadata benchmarks")
+    parser.add_argument("--file_size", type=int, default=64, help="File size in MB for the throughput benchmarks")
+    parser.add_argument("--io_size", type=int, default=128 * 1024, help="Bytes per read or write call")
+    parser.add_argument("--random_ops", type=int, default=1000, help="Number of reads or writes at random offsets")
+    parser.add_argument("--rename_files", type=int, default=100, help="Number of files in the renamed and removed folder")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latency in milliseconds of every B2 request")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="Bandwidth in MB/s of every B2 connection (0 is unlimited)")
+
+    parser.add_argument('--use_disk', dest='use_disk', action='store_true')
+    parser.set_defaults(use_disk=False)
+
+    parser.add_argument('--ranged_reads', dest='ranged_reads', action='store_true')
+    parser.set_defaults(ranged_reads=False)
+
+    parser.add_argument('--lazy_listing', dest='lazy_listing', action='store_true')
+    parser.set_defaults(lazy_listing=False)
+
+    parser.add_argument('--write_back', dest='write_back', action='store_true')
+    parser.set_defaults(write_back=False)
+
+    parser.add_argument("--benchmarks", type=str, nargs="+", default=None, help="Run only these benchmarks")
+    parser.add_argument("--json", type=str, default=None, help="Also write the results to this file, for comparing versions")
+
+    return parser
+
+
+#Runs B2Fuse operations the way FUSE calls them, against a fake B2 of its own
+class BenchmarkRun(object):
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+        self.b2_http = None
+
+    def reset_bucket(self):
+        if self.args.bandwidth > 0:
+            bandwidth = self.args.bandwidth * 1000 * 1000
+        else:
+            bandwidth = None
+
+        self.b2_http = FakeB2Http(self.args.latency / 1000.0, bandwidth)
+
+    @contextmanager
+    def mount(self):
+        temp_folder = tempfile.mkdtemp()
+        try:
+            with B2Fuse(
+                "benchmark", "benchmark", BUCKET_ID, False, os.path.join(temp_folder, "b2fuse"),
+                self.args.use_disk,
+                ranged_reads=self.args.ranged_reads,
+                lazy_listing=self.args.lazy_listing,
+                write_back=self.args.write_back,
+                b2_http=self.b2_http
+            ) as filesystem:
+                yield filesystem
+        finally:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+
+    @contextmanager
+    def timed(self, name, operations=None, transferred=None, **parameters):
+        start = default_timer()
+        yield
+        seconds = default_timer() - start
+
+        result = dict(name=name, seconds=seconds, parameters=parameters)
+        if operations is not None:
+            result["ops_per_second"] = operations / seconds
+        if transferred is not None:
+            result["mb_per_second"] = transferred / seconds / 1000 / 1000
+
+        self.results.append(result)
+        print(format_result(result))
+
+    def add_files(self, folder, count, data=b""):
+        for index in range(count):
+            self.b2_http.add_file(
+                BUCKET_ID, "%s/%05d/file%05d" % (folder, index // FILES_PER_FOLDER, index), data
+            )
+
+    def walk(self, filesystem, path):
+        entries = 0
+        for name in filesystem("readdir", path, 0):
+            if name in (".", ".."):
+                continue
+
+            child = os.path.join(path, name)
+            filesystem("getattr", child)
+            entries += 1
+
+            if name.isdigit():
+                entries += self.walk(filesystem, child)
+
+        return entries
+
+    def write_file(self, filesystem, path, data):
+        fh = filesystem("create", path, 0o644)
+        for offset in range(0, len(data), self.args.io_size):
+            filesystem("write", path, data[offset:offset + self.args.io_size], offset, fh)
+        filesystem("release", path, fh)
+
+    # Benchmarks
+    # ==================
+
+    def metadata(self):
+        for count in self.args.objects:
+            folder = "metadata%d" % count
+            self.reset_bucket()
+            self.add_files(folder, count)
+
+            with self.mount() as filesystem:
+                with self.timed("list", count, objects=count):
+                    filesystem("readdir", "/", 0)
+                    filesystem("readdir", "/" + folder, 0)
+
+                with self.timed("walk", count, objects=count):
+                    entries = self.walk(filesystem, "/" + folder)
+
+                assert entries == count + (count - 1) // FILES_PER_FOLDER + 1, entries
+
+                with self.timed("getattr", count, objects=count):
+                    for index in range(count):
+                        filesystem(
+                            "getattr", "/%s/%05d/file%05d" %
+                            (folder, index // FILES_PER_FOLDER, index)
+                        )
+
+    def sequential(self):
+        size = self.args.file_size * 1000 * 1000
+        data = os.urandom(size)
+        self.reset_bucket()
+
+        with self.mount() as filesystem:
+            filesystem("readdir", "/", 0)
+            with self.timed("sequential_write", transferred=size, file_size=size):
+                self.write_file(filesystem, "/sequential", data)
+
+        with self.mount() as filesystem:
+            filesystem("readdir", "/", 0)
+            with self.timed("sequential_read", transferred=size, file_size=size):
+                fh = filesystem("open", "/sequential", os.O_RDONLY)
+                for offset in range(0, size, self.args.io_size):
+                    filesystem("read", "/sequential", self.args.io_size, offset, fh)
+                filesystem("release", "/sequential", fh)
+
+    def random_access(self):
+        size = self.args.file_size * 1000 * 1000
+        self.reset_bucket()
+        self.b2_http.add_file(BUCKET_ID, "random", os.urandom(size))
+
+        #The same offsets for every version that is compared
+        generator = random.Random(size)
+        offsets = [
+            generator.randrange(0, size - self.args.io_size) for _ in range(self.args.random_ops)
+        ]
+        data = os.urandom(self.args.io_size)
+
+        with self.mount() as filesystem:
+            filesystem("readdir", "/", 0)
+            with self.timed(
+                "random_read", len(offsets), file_size=size, io_size=self.args.io_size
+            ):
+                fh = filesystem("open", "/random", os.O_RDONLY)
+                for offset in offsets:
+                    filesystem("read", "/random", self.args.io_size, offset, fh)
+                filesystem("release", "/random", fh)
+
+        with self.mount() as filesystem:
+            filesystem("readdir", "/", 0)
+            with self.timed(
+                "random_write", len(offsets), file_size=size, io_size=self.args.io_size
+            ):
+                fh = filesystem("open", "/random", os.O_RDWR)
+                for offset in offsets:
+                    filesystem("write", "/random", data, offset, fh)
+                filesystem("release", "/random", fh)
+
+    def rename(self):
+        count = self.args.rename_files
+        self.reset_bucket()
+        self.b2_http.add_file(BUCKET_ID, "rename/.keep", b"")
+        for index in range(count):
+            self.b2_http.add_file(BUCKET_ID, "rename/folder/file%05d" % index, b"x" * 1024)
+
+        with self.mount() as filesystem:
+            filesystem("readdir", "/", 0)
+            filesystem("readdir", "/rename", 0)
+
+            with self.timed("rename_folder", count, files=count):
+                filesystem("rename", "/rename/folder", "/rename/renamed")
+
+            with self.timed("rmdir", count, files=count):
+                filesystem("rmdir", "/rename/renamed")
+
+    BENCHMARKS = ("metadata", "sequential", "random_access", "rename")
+
+    def run(self):
+        for name in self.args.benchmarks or self.BENCHMARKS:
+            getattr(self, name)()
+
+        return self.results
+
+
+def format_result(result):
+    rates = []
+    if "ops_per_second" in result:
+        rates.append("%.0f ops/s" % result["ops_per_second"])
+    if "mb_per_second" in result:
+        rates.append("%.1f MB/s" % result["mb_per_second"])
+
+    parameters = " ".join(
+        "%s=%s" % (key, value) for key, value in sorted(result["parameters"].items())
+    )
+
+    return "%-16s %-36s %10.3f s  %s" % (
+        result["name"], parameters, result["seconds"], ", ".join(rates)
+    )
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    results = BenchmarkRun(args).run()
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(dict(arguments=vars(args), results=results), f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import json
+import logging
+import os
+import shutil
+import threading
+
+from collections import OrderedDict
+
+
+#Size bounded cache of file blocks on local disk, keyed by B2 file id and block offset.
+#File ids are never reused for new content, so cached blocks never go stale. The LRU
+#order is kept in an index file so the cache survives remounts.
+class BlockCache(object):
+    def __init__(self, cache_folder, max_size):
+        self.logger = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
+
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+
+        self._blocks_folder = os.path.join(self.cache_folder, "blocks")
+        self._temp_folder = os.path.join(self.cache_folder, "tmp")
+        self._index_filename = os.path.join(self.cache_folder, "index.json")
+
+        #(file_id, offset) -> block size, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(self._blocks_folder):
+            os.makedirs(self._blocks_folder)
+
+        #Blocks that were being written when the last mount stopped
+        if os.path.exists(self._temp_folder):
+            shutil.rmtree(self._temp_folder)
+        os.makedirs(self._temp_folder)
+
+        self._load_index()
+        self._evict()
+
+    def __len__(self):
+        return self._size
+
+    def _block_filename(self, file_id, offset):
+        return os.path.join(self._blocks_folder, file_id, str(offset))
+
+    def _load_index(self):
+        indexed = []
+        if os.path.exists(self._index_filename):
+            try:
+                with open(self._index_filename) as f:
+                    indexed = json.load(f)
+            except ValueError:
+                self.logger.warning("Block cache index is corrupt, rebuilding it")
+
+        #Blocks on disk are the ground truth, the index only supplies the LRU order
+        on_disk = {}
+        for file_id in os.listdir(self._blocks_folder):
+            for offset in os.listdir(os.path.join(self._blocks_folder, file_id)):
+                if not offset.isdigit():
+                    continue
+
+                filename = self._block_filename(file_id, offset)
+                on_disk[(file_id, int(offset))] = (
+                    os.path.getmtime(filename), os.path.getsize(filename)
+                )
+
+        for file_id, offset in indexed:
+            key = (file_id, offset)
+            if key in on_disk:
+                self._add_entry(key, on_disk.pop(key)[1])
+
+        #Blocks written after the index was last saved go in the order they were written
+        for key, (_, size) in sorted(on_disk.items(), key=lambda item: item[1][0]):
+            self._add_entry(key, size)
+
+        self.logger.info("Block cache loaded %s blocks (%s bytes)", len(self._entries), self._size)
+
+    def _save_index(self):
+        temp_filename = self._index_filename + ".tmp"
+        with open(temp_filename, "w") as f:
+            json.dump([list(key) for key in self._entries], f)
+        os.rename(temp_filename, self._index_filename)
+
+    def _add_entry(self, key, size):
+        self._entries[key] = size
+        self._size += size
+
+    def _remove_entry(self, key):
+        self._size -= self._entries.pop(key, 0)
+
+        filename = self._block_filename(*key)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        folder = os.path.dirname(filename)
+        if os.path.exists(folder) and not os.listdir(folder):
+            os.rmdir(folder)
+
+    def _evict(self):
+        while self._size > self.max_size and self._entries:
+            self._remove_entry(next(iter(self._entries)))
+
+    def get(self, file_id, offset, length):
+        data = self._read_block(file_id, offset, length)
+
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return data
+
+    def _read_block(self, file_id, offset, length):
+        key = (file_id, offset)
+
+        with self._lock:
+            #Blocks of another length were cached with a different block size
+            if self._entries.get(key) != length:
+                return None
+
+            self._entries[key] = self._entries.pop(key)
+
+        try:
+            with open(self._block_filename(file_id, offset), "rb") as f:
+                data = f.read()
+        except (IOError, OSError):
+            #The block was evicted while it was being read
+            return None
+
+        if len(data) != length:
+            return None
+
+        return data
+
+    def put(self, file_id, offset, data):
+        key = (file_id, offset)
+
+        if len(data) > self.max_size:
+            return
+
+        #Write to a temporary file first so a crash never leaves a partial block
+        temp_filename = os.path.join(
+            self._temp_folder, "%s_%s_%s" % (file_id, offset, threading.current_thread().ident)
+        )
+        with open(temp_filename, "wb") as f:
+            f.write(data)
+
+        with self._lock:
+            self._remove_entry(key)
+
+            filename = self._block_filename(file_id, offset)
+            folder = os.path.dirname(filename)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+            os.rename(temp_filename, filename)
+
+            self._add_entry(key, len(data))
+            self._evict()
+
+    def discard(self, file_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == file_id]:
+                self._remove_entry(key)
+
+    def close(self):
+        with self._lock:
+            self._save_index()
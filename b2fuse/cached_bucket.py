@@ -23,73 +23,416 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #SOFTWARE.
 
+import logging
+import threading
+
+from concurrent import futures
 from time import time
 
-from b2.bucket import Bucket
+from b2.bucket import Bucket, LargeFileUploadState
+from b2.exception import B2Error, MaxRetriesExceeded
+from b2.file_version import FileVersionInfoFactory
+from b2.progress import DoNothingProgressListener
+from b2.utils import choose_part_ranges, validate_b2_file_name
 
 
-#General cache used for B2Bucket
+#General cache used for B2Bucket. Results are kept for max_staleness seconds after
+#they expire, so they can be served while they are being refreshed.
 class Cache(object):
-    def __init__(self, cache_timeout):
+    def __init__(self, cache_timeout, max_staleness=0):
         self.data = {}
 
         self.cache_timeout = cache_timeout
+        self.max_staleness = max_staleness
 
     def update(self, result, params=""):
         self.data[params] = (time(), result)
 
-    def get(self, params=""):
+    def lookup(self, params=""):
+        #Returns the result and whether it has expired
         if self.data.get(params) is not None:
             entry_time, result = self.data.get(params)
-            if time() - entry_time < self.cache_timeout:
-                return result
+            age = time() - entry_time
+            if age < self.cache_timeout:
+                return result, False
+            elif age < self.cache_timeout + self.max_staleness:
+                return result, True
             else:
                 del self.data[params]
 
-        return
+        return None, False
+
+    def patch(self, patch_result):
+        #Replaces every result by patch_result(params, result), None drops the result
+        for params, (entry_time, result) in list(self.data.items()):
+            new_result = patch_result(params, result)
+            if new_result is None:
+                del self.data[params]
+            elif new_result is not result:
+                self.data[params] = (entry_time, new_result)
+
+    def get(self, params=""):
+        result, expired = self.lookup(params)
+        if expired:
+            return
+
+        return result
 
 
 class CacheNotFound(BaseException):
     pass
 
 
+def _entry_name(entry):
+    file_version_info, folder_name = entry
+    return folder_name if folder_name is not None else file_version_info.file_name
+
+
+def _find_entry(entries, name):
+    #Listings are sorted by name, returns the index of name or where it belongs
+    low, high = 0, len(entries)
+    while low < high:
+        middle = (low + high) // 2
+        if _entry_name(entries[middle]) < name:
+            low = middle + 1
+        else:
+            high = middle
+
+    return low
+
+
 class CachedBucket(Bucket):
-    def __init__(self, api, bucket_id):
+    def __init__(
+        self, api, bucket_id, large_file_threshold=200 * 1000 * 1000,
+        part_size=100 * 1000 * 1000, upload_threads=4, cache_timeout=120, max_staleness=600
+    ):
         super(CachedBucket, self).__init__(api, bucket_id)
 
+        self.logger = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
+
         self._cache = {}
+        self._cache_lock = threading.Lock()
 
-        self._cache_timeout = 120
+        self._cache_timeout = cache_timeout
+        self._max_staleness = max_staleness
 
-    def _reset_cache(self):
-        self._cache = {}
+        #Bumped on every change, so refreshes started before it are not stored
+        self._cache_generation = 0
+
+        #Expired results are refreshed one at a time in the background
+        self._refresh_pool = futures.ThreadPoolExecutor(max_workers=1)
+        self._refreshing = set()
+
+        self._cache_stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0}
+
+        #Files of at least this size are uploaded in parts by a pool of upload threads
+        self.large_file_threshold = large_file_threshold
+        self.part_size = part_size
+        self.upload_threads = upload_threads
+        self._upload_pool = futures.ThreadPoolExecutor(max_workers=self.upload_threads)
+
+    def _patch_cache(self, cache_name, patch_result):
+        with self._cache_lock:
+            #Refreshes started before the change would undo it
+            self._cache_generation += 1
+
+            if self._cache.get(cache_name) is not None:
+                self._cache[cache_name].patch(patch_result)
 
-    def _update_cache(self, cache_name, result, params=""):
-        self._cache[cache_name].update(result, params)
+    def _patch_listings(self, file_name, file_version_info=None, deleted_file_id=None):
+        #Puts an uploaded file into, or removes a deleted one from, the cached listings of
+        #the folders above it. Listings of a folder whose subfolder may have become empty
+        #are dropped instead. Entries are found by bisection and inserted in place, so a
+        #write costs no copy or sort of large listings.
+        def patch_listing(params, result):
+            folder_to_list, recursive = params
+            prefix = folder_to_list
+            if prefix != '' and not prefix.endswith('/'):
+                prefix += '/'
+
+            if not file_name.startswith(prefix):
+                return result
+
+            relative_name = file_name[len(prefix):]
+            if recursive or "/" not in relative_name:
+                index = _find_entry(result, file_name)
+                found = (
+                    index < len(result) and result[index][1] is None and
+                    result[index][0].file_name == file_name
+                )
+
+                if file_version_info is not None:
+                    if found:
+                        result[index] = (file_version_info, None)
+                    else:
+                        result.insert(index, (file_version_info, None))
+                elif found and result[index][0].id_ == deleted_file_id:
+                    del result[index]
+
+                return result
+
+            if file_version_info is None:
+                return None
+
+            folder_name = prefix + relative_name.split("/")[0] + "/"
+            index = _find_entry(result, folder_name)
+            if index < len(result) and result[index][1] == folder_name:
+                return result
+
+            result.insert(index, (file_version_info, folder_name))
+            return result
+
+        self._patch_cache("ls", patch_listing)
+
+    def _update_cache(self, cache_name, result, params="", generation=None):
+        with self._cache_lock:
+            if generation is not None and generation != self._cache_generation:
+                return result
+
+            #Cached results are patched in place, callers keep the copy they were given
+            if self._cache.get(cache_name) is not None:
+                self._cache[cache_name].update(list(result), params)
         return result
 
-    def _get_cache(self, cache_name, params="", cache_type=Cache):
-        if self._cache.get(cache_name) is None:
-            self._cache[cache_name] = cache_type(self._cache_timeout)
+    def _get_cache(self, cache_name, params="", cache_type=Cache, refresh=None):
+        #With a refresh function expired results are returned and refreshed in the background
+        start_refresh = False
+
+        with self._cache_lock:
+            if self._cache.get(cache_name) is None:
+                self._cache[cache_name] = cache_type(self._cache_timeout, self._max_staleness)
+
+            if refresh is None:
+                result, expired = self._cache[cache_name].get(params), False
+            else:
+                result, expired = self._cache[cache_name].lookup(params)
+
+            if result is None:
+                self._cache_stats['misses'] += 1
+            elif expired:
+                self._cache_stats['stale_hits'] += 1
+                if (cache_name, params) not in self._refreshing:
+                    self._refreshing.add((cache_name, params))
+                    start_refresh = True
+            else:
+                self._cache_stats['hits'] += 1
+
+            generation = self._cache_generation
+
+            if result is not None:
+                result = list(result)
 
-        if self._cache[cache_name].get(params) is not None:
-            return self._cache[cache_name].get(params)
+        if start_refresh:
+            self._refresh_pool.submit(
+                self._refresh_cache, cache_name, params, refresh, generation
+            )
+
+        if result is not None:
+            return result
 
         raise CacheNotFound()
 
-    def ls(self):
+    def _refresh_cache(self, cache_name, params, refresh, generation):
+        try:
+            self._update_cache(cache_name, refresh(), params, generation)
+
+            with self._cache_lock:
+                self._cache_stats['refreshes'] += 1
+        except Exception:
+            self.logger.exception("Refreshing cached %s %s failed", cache_name, params)
+        finally:
+            with self._cache_lock:
+                self._refreshing.discard((cache_name, params))
+
+    def get_cache_generation(self):
+        #Changes when files are uploaded or deleted through this bucket
+        with self._cache_lock:
+            return self._cache_generation
+
+    def get_cache_stats(self):
+        with self._cache_lock:
+            return dict(self._cache_stats)
+
+    def ls(self, folder_to_list='', recursive=True):
         func_name = "ls"
+        params = (folder_to_list, recursive)
+
+        def list_folder():
+            return list(super(CachedBucket, self).ls(folder_to_list, recursive=recursive))
 
         try:
-            return self._get_cache(func_name)
+            return self._get_cache(func_name, params, refresh=list_folder)
         except CacheNotFound:
-            result = list(super(CachedBucket, self).ls())
-            return self._update_cache(func_name, result)
+            #A listing that was overtaken by an upload or delete is not cached
+            generation = self.get_cache_generation()
+            return self._update_cache(func_name, list_folder(), params, generation)
+
+    def ls_versions(self, prefix, fetch_count=1000):
+        #Every version of the files whose names start with prefix, newest first for each
+        #name. Versions are not cached, they are only listed to delete a file for good.
+        start_file_name = prefix
+        start_file_id = None
+        while True:
+            response = self.list_file_versions(start_file_name, start_file_id, fetch_count)
+            for entry in response['files']:
+                if not entry['fileName'].startswith(prefix):
+                    return
+
+                #Unfinished large files are not versions of the file yet
+                if entry['action'] != 'start':
+                    yield FileVersionInfoFactory.from_api_response(entry)
+
+            if response['nextFileName'] is None:
+                return
+
+            start_file_name = response['nextFileName']
+            start_file_id = response.get('nextFileId')
+
+    def delete_file_version(self, file_id, file_name):
+        result = super(CachedBucket, self).delete_file_version(file_id, file_name)
+        self._patch_listings(file_name, deleted_file_id=file_id)
+        return result
+
+    def upload(
+        self,
+        upload_source,
+        file_name,
+        content_type=None,
+        file_info=None,
+        min_part_size=None,
+        progress_listener=None
+    ):
+        validate_b2_file_name(file_name)
+        file_info = file_info or {}
+        content_type = content_type or self.DEFAULT_CONTENT_TYPE
+        progress_listener = progress_listener or DoNothingProgressListener()
+
+        if not self._is_large_file(upload_source.get_content_length()):
+            result = self._upload_small_file(
+                upload_source, file_name, content_type, file_info, progress_listener
+            )
+        else:
+            #B2 does not hash large files, the recorded hash lets downloads be checked
+            file_info = dict(file_info, large_file_sha1=upload_source.get_content_sha1())
+            result = self._upload_parallel_large_file(
+                upload_source, file_name, content_type, file_info
+            )
+
+        self._patch_listings(file_name, result)
+        return result
+
+    def _upload_small_file(
+        self, upload_source, file_name, content_type, file_info, progress_listener
+    ):
+        #Open files know their SHA1, so it is sent up front and the body is streamed as is
+        #instead of being hashed again on the way out
+        content_length = upload_source.get_content_length()
+        content_sha1 = upload_source.get_content_sha1()
+
+        exception_list = []
+        for _ in range(self.MAX_UPLOAD_ATTEMPTS):
+            upload_url, upload_auth_token = self._get_upload_data()
+
+            try:
+                with upload_source.open() as data_stream:
+                    response = self.api.raw_api.upload_file(
+                        upload_url, upload_auth_token, file_name, content_length, content_type,
+                        content_sha1, file_info, data_stream
+                    )
+
+                self.api.account_info.put_bucket_upload_url(
+                    self.id_, upload_url, upload_auth_token
+                )
+                return FileVersionInfoFactory.from_api_response(response)
 
-    def delete_file_version(self, *args, **kwargs):
-        self._reset_cache()
-        return super(CachedBucket, self).delete_file_version(*args, **kwargs)
+            except B2Error as e:
+                self.logger.warning("Upload of %s failed (%s)", file_name, e)
+                if not e.should_retry_upload():
+                    raise
+
+                exception_list.append(e)
+                self.api.account_info.clear_bucket_upload_data(self.id_)
+
+        raise MaxRetriesExceeded(self.MAX_UPLOAD_ATTEMPTS, exception_list)
+
+    def _is_large_file(self, content_length):
+        #A large file needs at least two parts of the account's minimum part size
+        minimum_part_size = self.api.account_info.get_minimum_part_size()
+        return content_length >= max(self.large_file_threshold, 2 * minimum_part_size)
+
+    def _choose_part_ranges(self, content_length):
+        #At least two parts, none of them under the minimum part size B2 accepts
+        minimum_part_size = self.api.account_info.get_minimum_part_size()
+        part_size = max(min(self.part_size, content_length // 2), minimum_part_size)
+        return choose_part_ranges(content_length, part_size)
+
+    def _upload_parallel_large_file(self, upload_source, file_name, content_type, file_info):
+        part_ranges = self._choose_part_ranges(upload_source.get_content_length())
+
+        file_id = self.start_large_file(file_name, content_type, file_info).file_id
+        large_file_upload_state = LargeFileUploadState(DoNothingProgressListener())
+
+        #Every part is read from the upload source by the thread uploading it
+        part_futures = [
+            self._upload_pool.submit(
+                self._upload_part, file_id, part_index + 1, part_range, upload_source,
+                large_file_upload_state
+            ) for part_index, part_range in enumerate(part_ranges)
+        ]
+        futures.wait(part_futures)
+
+        #Unfinished large files are kept by B2 until they are cancelled
+        try:
+            part_sha1_array = [f.result()['contentSha1'] for f in part_futures]
+            response = self.api.session.finish_large_file(file_id, part_sha1_array)
+        except Exception:
+            self.cancel_large_file(file_id)
+            raise
+
+        return FileVersionInfoFactory.from_api_response(response)
+
+    def copy_file(
+        self, source_file_id, new_file_name, content_length, file_info=None, content_type=None
+    ):
+        #Copies are made by B2, large files part by part in parallel
+        validate_b2_file_name(new_file_name)
+
+        if not self._is_large_file(content_length):
+            response = self.api.session.copy_file(source_file_id, new_file_name)
+            result = FileVersionInfoFactory.from_api_response(response)
+        else:
+            #Small copies keep the content type of their source, large ones are started with it
+            if content_type is None:
+                content_type = self.api.session.get_file_info(source_file_id)['contentType']
+
+            result = self._copy_parallel_large_file(
+                source_file_id, new_file_name, content_length, file_info or {}, content_type
+            )
+
+        self._patch_listings(new_file_name, result)
+        return result
+
+    def _copy_parallel_large_file(
+        self, source_file_id, file_name, content_length, file_info, content_type
+    ):
+        part_ranges = self._choose_part_ranges(content_length)
+
+        file_id = self.start_large_file(file_name, content_type, file_info).file_id
+
+        part_futures = [
+            self._upload_pool.submit(
+                self.api.session.copy_part, source_file_id, file_id, part_index + 1,
+                (offset, offset + length - 1)
+            ) for part_index, (offset, length) in enumerate(part_ranges)
+        ]
+        futures.wait(part_futures)
+
+        #Unfinished large files are kept by B2 until they are cancelled
+        try:
+            part_sha1_array = [f.result()['contentSha1'] for f in part_futures]
+            response = self.api.session.finish_large_file(file_id, part_sha1_array)
+        except Exception:
+            self.cancel_large_file(file_id)
+            raise
 
-    def upload_bytes(self, *args, **kwargs):
-        self._reset_cache()
-        return super(CachedBucket, self).upload_bytes(*args, **kwargs)
+        return FileVersionInfoFactory.from_api_response(response)
@@ -0,0 +1,155 @@
+import unittest
+
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from timeit import default_timer
+
+from fuse import FuseOSError
+from .b2fuse_main import B2Fuse
+from .fake_b2 import FakeB2Http
+
+BUCKET_ID = "concurrency"
+
+
+#Calls B2Fuse from several threads like FUSE does with --multithreaded, against a fake
+#of B2 with a latency per request
+class ConcurrencyTestCase(unittest.TestCase):
+    LATENCY = 0.05
+    THREADS = 8
+
+    #Files in the bucket when it is mounted
+    FILES = dict(("file%d" % index, b"data %d" % index) for index in range(THREADS))
+
+    def setUp(self):
+        self._b2_http = FakeB2Http(latency=self.LATENCY)
+        for name, data in self.FILES.items():
+            self._b2_http.add_file(BUCKET_ID, name, data)
+
+        self._temp_folder = tempfile.mkdtemp()
+        self._filesystem = B2Fuse(
+            "concurrency", "concurrency", BUCKET_ID, False,
+            os.path.join(self._temp_folder, "b2fuse"), False, b2_http=self._b2_http
+        )
+        self._filesystem("readdir", "/", 0)
+
+    def tearDown(self):
+        self._filesystem.__exit__()
+        shutil.rmtree(self._temp_folder, ignore_errors=True)
+
+    def run_threads(self, target, count):
+        #Runs target(index) in count threads and returns the first error raised
+        errors = []
+
+        def run(index):
+            try:
+                target(index)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(index, )) for index in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return errors[0] if len(errors) > 0 else None
+
+    def read_file(self, path):
+        fh = self._filesystem("open", path, os.O_RDONLY)
+        data = self._filesystem("read", path, 1024 * 1024, 0, fh)
+        self._filesystem("release", path, fh)
+        return data
+
+
+class TestParallelFiles(ConcurrencyTestCase):
+
+    def test_reads_of_different_files_scale(self):
+        paths = ["/" + name for name in self.FILES]
+
+        start = default_timer()
+        for path in paths:
+            self.assertEqual(self.read_file(path), self.FILES[path[1:]])
+        serial = default_timer() - start
+
+        start = default_timer()
+        error = self.run_threads(lambda index: self.read_file(paths[index]), len(paths))
+        parallel = default_timer() - start
+
+        self.assertIsNone(error)
+        self.assertLess(parallel, serial / 2, "Reads of different files did not run in parallel")
+
+    def test_uploads_of_different_files_scale(self):
+        def write_file(index):
+            path = "/upload%d" % index
+            fh = self._filesystem("create", path, 0o644)
+            self._filesystem("write", path, b"data", 0, fh)
+            self._filesystem("flush", path, fh)
+            self._filesystem("release", path, fh)
+
+        start = default_timer()
+        write_file(0)
+        serial = (default_timer() - start) * self.THREADS
+
+        start = default_timer()
+        error = self.run_threads(write_file, self.THREADS)
+        parallel = default_timer() - start
+
+        self.assertIsNone(error)
+        self.assertLess(parallel, serial / 2, "Uploads of different files did not run in parallel")
+
+
+class TestSharedFile(ConcurrencyTestCase):
+
+    def test_concurrent_readers_share_the_file(self):
+        def read(index):
+            for _ in range(10):
+                self.assertEqual(self.read_file("/file0"), self.FILES["file0"])
+
+        self.assertIsNone(self.run_threads(read, self.THREADS))
+        self.assertEqual(len(self._filesystem.open_files), 0)
+
+
+class TestGetattr(ConcurrencyTestCase):
+    #Without latency files are opened and released as often as possible, and threads
+    #switch often
+    LATENCY = 0
+
+    def setUp(self):
+        super(TestGetattr, self).setUp()
+        self._switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self._switch_interval)
+        super(TestGetattr, self).tearDown()
+
+    def test_getattr_while_files_are_released(self):
+        stop = threading.Event()
+
+        def write_and_stat(index):
+            path = "/stat%d" % (index // 2)
+
+            if index % 2 == 0:
+                for _ in range(500):
+                    fh = self._filesystem("create", path, 0o644)
+                    self._filesystem("write", path, b"data", 0, fh)
+                    self._filesystem("release", path, fh)
+                stop.set()
+                return
+
+            while not stop.is_set():
+                try:
+                    self._filesystem("getattr", path)
+                except FuseOSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+        self.assertIsNone(self.run_threads(write_and_stat, self.THREADS))
+
+
+if __name__ == "__main__":
+    unittest.main()
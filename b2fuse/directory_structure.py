@@ -23,13 +23,19 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #SOFTWARE.
 
+from .locking import ReadWriteLock, read_locked, write_locked
+
 
 class Directory(object):
     def __init__(self, name):
         self._name = name
-        self._content = []
+        self._content = {}
         self._directories = {}
 
+        #Usage of all files in this directory and below it
+        self.total_size = 0
+        self.total_files = 0
+
     def __len__(self):
         return len(self._directories)
 
@@ -40,106 +46,269 @@ class Directory(object):
         return self._directories.get(name)
 
     def get_directories(self):
-        return self._directories.values()
+        return list(self._directories.values())
 
     def add_directory(self, name):
         self._directories[name] = Directory(name)
+        return self._directories[name]
+
+    def remove_directory(self, name):
+        return self._directories.pop(name, None)
 
     def add_file(self, file_info):
-        self._content.append(file_info)
+        self._content[file_info['fileName']] = file_info
 
-    def get_file_info(self, name):
-        file_info = list(filter(lambda f: str(f['fileName']) == name, self._content))
+    def remove_file(self, name):
+        self._content.pop(name, None)
 
-        if len(file_info) == 1:
-            return file_info[0]
-        else:
-            return None
+    def add_usage(self, size, files):
+        self.total_size += size
+        self.total_files += files
+
+    def is_empty(self):
+        return len(self._content) == 0 and len(self._directories) == 0
+
+    def get_file_info(self, name):
+        return self._content.get(name)
 
     def get_file_infos(self):
-        return self._content
+        return list(self._content.values())
 
     def __repr__(self):
         return self._name
 
     def get_content_names(self):
-        files = [file_info['fileName'] for file_info in self._content]
-        directories = map(str, self._directories)
+        files = [file_info['fileName'] for file_info in self._content.values()]
+        directories = list(map(str, self._directories))
 
         return directories + files
 
 
 class DirectoryStructure(object):
     def __init__(self):
-        self._directories = Directory("")
+        #Lookups happen far more often than updates
+        self._lock = ReadWriteLock()
 
-    def update_structure(self, file_info_list, local_directories):
+        self._reset()
+
+    def _reset(self):
         self._directories = Directory("")
 
-        local_directories_split = map(lambda f: f.split("/"), local_directories)
-        for directory in local_directories_split:
-            self._lookup(self._directories, directory, True)
+        #Flat indexes from full path to directory and file info
+        self._directory_index = {"": self._directories}
+        self._file_index = {}
+
+        #Directories created locally, these are kept even when empty
+        self._local_directories = set()
 
-        online_directories_split = map(
-            lambda file_info: file_info['fileName'].split("/")[:-1], file_info_list
-        )
-        for directory in online_directories_split:
-            self._lookup(self._directories, directory, True)
+        #Directories whose content has been listed on its own (lazy listing)
+        self._listed_directories = set()
+
+    @write_locked
+    def update_structure(self, file_info_list, local_directories):
+        self._reset()
+
+        for directory in local_directories:
+            self.add_directory(directory)
 
         for file_info in file_info_list:
-            folder_path_split = file_info['fileName'].split("/")[:-1]
-            folder_path = "/".join(folder_path_split)
-            directory = self.get_directory(folder_path)
-            directory.add_file(file_info)
+            self.add_file(file_info)
 
-    def _lookup(self, directory, path, update=False):
-        if len(path) == 0:
-            return directory
+    @write_locked
+    def update_directory(self, path, file_info_list, directory_names, is_current=None):
+        #Replaces the direct content of a single directory and returns the paths that changed,
+        #or None without changing anything if is_current() tells the listing is out of date
+        if is_current is not None and not is_current():
+            return None
 
-        head = path.pop(0)
-        if update and directory.get_directory(head) is None:
-            directory.add_directory(head)
+        directory = self._make_directory(path)
+        self._listed_directories.add(path)
 
-        if directory.get_directory(head) is not None:
-            return self._lookup(directory.get_directory(head), path, update)
-        else:
+        prefix = path + "/" if len(path) > 0 else ""
+        changed_paths = []
+
+        file_infos = dict((file_info['fileName'], file_info) for file_info in file_info_list)
+        for file_info in directory.get_file_infos():
+            if file_info['fileName'] not in file_infos:
+                directory.remove_file(file_info['fileName'])
+                del self._file_index[file_info['fileName']]
+                self._update_usage(path, -file_info['size'], -1)
+                changed_paths.append(file_info['fileName'])
+
+        for file_name, file_info in file_infos.items():
+            old_file_info = directory.get_file_info(file_name)
+            if old_file_info is None or old_file_info['fileId'] != file_info['fileId']:
+                changed_paths.append(file_name)
+
+            self.add_file(file_info)
+
+        for name in directory_names:
+            if directory.get_directory(name) is None:
+                self._make_directory(prefix + name)
+                changed_paths.append(prefix + name)
+
+        for name in [str(subdirectory) for subdirectory in directory.get_directories()]:
+            if name not in directory_names and prefix + name not in self._local_directories:
+                self.remove_directory(prefix + name)
+                changed_paths.append(prefix + name)
+
+        return changed_paths
+
+    @write_locked
+    def reconcile(self, file_info_list, is_current=None):
+        #Applies a listing of the whole bucket, only touching files that changed, and
+        #returns their paths. Like update_directory it returns None for outdated listings.
+        if is_current is not None and not is_current():
             return None
 
-    def is_directory(self, path):
-        return self.get_directories(path) is not None
+        file_infos = dict((file_info['fileName'], file_info) for file_info in file_info_list)
+        changed_paths = []
 
-    def is_file(self, path):
-        return self.get_file_info(path) is not None
+        for file_name in [name for name in self._file_index if name not in file_infos]:
+            self.remove_file(file_name)
+            changed_paths.append(file_name)
 
-    def get_directories(self, path):
-        if len(path) == 0:
-            return self._directories.get_directories()
-        else:
-            path_split = path.split("/")
-            r = self._lookup(self._directories, path_split)
+        for file_name, file_info in file_infos.items():
+            old_file_info = self._file_index.get(file_name)
+            if old_file_info is None or old_file_info['fileId'] != file_info['fileId']:
+                self.add_file(file_info)
+                changed_paths.append(file_name)
 
-            if r is not None:
-                return r.get_directories()
-            else:
-                return None
+        return changed_paths
 
-    def get_directory(self, path):
-        if len(path) == 0:
-            return self._directories
+    @read_locked
+    def is_listed(self, path):
+        return path in self._listed_directories
+
+    @write_locked
+    def add_file(self, file_info):
+        #Adds a file or replaces the previous version of it
+        folder_path = file_info['fileName'].rpartition("/")[0]
+        self._make_directory(folder_path).add_file(file_info)
+
+        old_file_info = self._file_index.get(file_info['fileName'])
+        self._file_index[file_info['fileName']] = file_info
+
+        if old_file_info is None:
+            self._update_usage(folder_path, file_info['size'], 1)
         else:
-            path_split = path.split("/")
-            r = self._lookup(self._directories, path_split)
+            self._update_usage(folder_path, file_info['size'] - old_file_info['size'], 0)
+
+    @write_locked
+    def remove_file(self, path):
+        file_info = self._file_index.pop(path, None)
+        if file_info is None:
+            return
+
+        folder_path = path.rpartition("/")[0]
+        self._directory_index[folder_path].remove_file(path)
+        self._update_usage(folder_path, -file_info['size'], -1)
+        self._prune_directory(folder_path)
+
+    @write_locked
+    def add_directory(self, path):
+        self._local_directories.add(path)
+        self._make_directory(path)
+
+    @write_locked
+    def remove_directory(self, path):
+        self._local_directories.discard(path)
+
+        directory = self._directory_index.get(path)
+        if directory is None or len(path) == 0:
+            return
+
+        parent_path, _, name = path.rpartition("/")
+        self._update_usage(parent_path, -directory.total_size, -directory.total_files)
+
+        #Drop the directory and everything below it from the indexes
+        directories = [(path, directory)]
+        while len(directories) > 0:
+            directory_path, directory = directories.pop()
+
+            del self._directory_index[directory_path]
+            self._local_directories.discard(directory_path)
+            self._listed_directories.discard(directory_path)
+            for file_info in directory.get_file_infos():
+                del self._file_index[file_info['fileName']]
+
+            directories.extend(
+                (directory_path + "/" + str(subdirectory), subdirectory)
+                for subdirectory in directory.get_directories()
+            )
+
+        self._directory_index[parent_path].remove_directory(name)
+        self._prune_directory(parent_path)
+
+    def _update_usage(self, path, size, files):
+        #Usage is kept for every directory up to the root, so reading it is constant time
+        while True:
+            self._directory_index[path].add_usage(size, files)
+            if len(path) == 0:
+                return
+
+            path = path.rpartition("/")[0]
+
+    def _prune_directory(self, path):
+        #Directories only exist in B2 as long as there are files in them
+        while len(path) > 0 and path not in self._local_directories:
+            directory = self._directory_index[path]
+            if not directory.is_empty():
+                return
+
+            parent_path, _, name = path.rpartition("/")
+            self._directory_index[parent_path].remove_directory(name)
+            del self._directory_index[path]
+            self._listed_directories.discard(path)
+
+            path = parent_path
+
+    def _make_directory(self, path):
+        directory = self._directory_index.get(path)
+        if directory is not None:
+            return directory
 
-            return r
+        parent_path, _, name = path.rpartition("/")
+        directory = self._make_directory(parent_path).add_directory(name)
+        self._directory_index[path] = directory
 
-    def get_file_info(self, path):
-        path_split = path.split("/")
+        return directory
+
+    @read_locked
+    def is_directory(self, path):
+        return path in self._directory_index
 
-        file_path = path_split[:-1]
+    @read_locked
+    def is_file(self, path):
+        return path in self._file_index
 
-        directory = self._lookup(self._directories, file_path)
+    @read_locked
+    def get_directories(self, path):
+        directory = self._directory_index.get(path)
 
         if directory is not None:
-            return directory.get_file_info(path)
+            return directory.get_directories()
         else:
             return None
+
+    @read_locked
+    def get_directory(self, path):
+        return self._directory_index.get(path)
+
+    @read_locked
+    def get_usage(self, path):
+        #Returns the total size and number of files below a directory
+        directory = self._directory_index.get(path)
+
+        if directory is not None:
+            return directory.total_size, directory.total_files
+        else:
+            return None
+
+    @read_locked
+    def get_file_infos(self):
+        return list(self._file_index.values())
+
+    @read_locked
+    def get_file_info(self, path):
+        return self._file_index.get(path)
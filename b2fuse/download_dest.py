@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+from contextlib import contextmanager
+
+from b2.download_dest import AbstractDownloadDestination
+
+
+#Write-only file-like object passing every write on with its offset in the file
+class OffsetWriter(object):
+    def __init__(self, write_at, offset):
+        self._write_at = write_at
+        self._position = offset
+
+    def write(self, data):
+        self._write_at(self._position, data)
+        self._position += len(data)
+
+
+#Writes a download (or a range of it) at its offset, so parts can arrive in any order
+class DownloadDestOffset(AbstractDownloadDestination):
+    def __init__(self, write_at, offset=0):
+        self.write_at = write_at
+        self.offset = offset
+        self.bytes_written = 0
+
+    def _write_at(self, offset, data):
+        self.write_at(offset, data)
+        self.bytes_written += len(data)
+
+    @contextmanager
+    def make_file_context(
+        self,
+        file_id,
+        file_name,
+        content_length,
+        content_type,
+        content_sha1,
+        file_info,
+        mod_time_millis,
+        range_=None
+    ):
+        yield OffsetWriter(self._write_at, self.offset)
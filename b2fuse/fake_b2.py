@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import bisect
+import hashlib
+import itertools
+import threading
+import time
+
+from contextlib import contextmanager
+
+from b2.exception import interpret_b2_error
+from b2.raw_api import HEX_DIGITS_AT_END
+from six.moves.urllib.parse import unquote_plus
+
+API_URL = "http://api.fake-b2"
+DOWNLOAD_URL = "http://download.fake-b2"
+UPLOAD_URL = "http://upload.fake-b2"
+
+ACCOUNT_ID = "fake-account"
+
+MINIMUM_PART_SIZE = 5 * 1000 * 1000
+
+
+class FakeFile(object):
+    def __init__(
+        self, bucket_id, file_id, file_name, data, content_type, content_sha1, file_info,
+        large=False
+    ):
+        self.bucket_id = bucket_id
+        self.file_id = file_id
+        self.file_name = file_name
+        self.data = data
+        self.content_type = content_type
+        self.content_sha1 = content_sha1
+        self.file_info = file_info
+        self.upload_timestamp = int(time.time() * 1000)
+
+        #Part number -> data of an unfinished large file
+        self.parts = {} if large else None
+
+    def as_dict(self):
+        return {
+            'accountId': ACCOUNT_ID,
+            'action': 'upload' if self.parts is None else 'start',
+            'bucketId': self.bucket_id,
+            'fileId': self.file_id,
+            'fileName': self.file_name,
+            'contentLength': len(self.data),
+            'size': len(self.data),
+            'contentSha1': self.content_sha1,
+            'contentType': self.content_type,
+            'fileInfo': self.file_info,
+            'uploadTimestamp': self.upload_timestamp,
+        }
+
+
+#The files of one bucket, with every version of a name kept like B2 does. Unfinished
+#large files are known by id but not listed until they are finished.
+class FakeBucket(object):
+    def __init__(self):
+        self.files = {}
+
+        #File name -> file ids of its versions, newest last
+        self.versions = {}
+
+        #Sorted file names, rebuilt on the next listing after names come or go
+        self._names = []
+        self._names_changed = False
+
+    def add(self, fake_file):
+        self.files[fake_file.file_id] = fake_file
+        if fake_file.parts is not None:
+            return
+
+        if fake_file.file_name not in self.versions:
+            self.versions[fake_file.file_name] = []
+            self._names_changed = True
+
+        self.versions[fake_file.file_name].append(fake_file.file_id)
+
+    def remove(self, file_id):
+        fake_file = self.files.pop(file_id)
+        if fake_file.parts is not None:
+            return
+
+        versions = self.versions[fake_file.file_name]
+        versions.remove(file_id)
+        if len(versions) == 0:
+            del self.versions[fake_file.file_name]
+            self._names_changed = True
+
+    def _sort_names(self):
+        if self._names_changed:
+            self._names = sorted(self.versions)
+            self._names_changed = False
+
+    def list_file_names(self, start_file_name, max_file_count):
+        self._sort_names()
+
+        files = []
+        index = bisect.bisect_left(self._names, start_file_name or "")
+        while index < len(self._names) and len(files) < max_file_count:
+            files.append(self.files[self.versions[self._names[index]][-1]].as_dict())
+            index += 1
+
+        if index < len(self._names):
+            next_file_name = self._names[index]
+        else:
+            next_file_name = None
+
+        return {'files': files, 'nextFileName': next_file_name}
+
+    def list_file_versions(self, start_file_name, start_file_id, max_file_count):
+        #Versions are listed by name, newest first for each name
+        self._sort_names()
+
+        files = []
+        index = bisect.bisect_left(self._names, start_file_name or "")
+        version_index = 0
+        if (
+            start_file_id is not None and index < len(self._names) and
+            self._names[index] == start_file_name
+        ):
+            version_index = self.versions[start_file_name][::-1].index(start_file_id)
+
+        while index < len(self._names):
+            file_ids = self.versions[self._names[index]][::-1]
+            while version_index < len(file_ids):
+                if len(files) == max_file_count:
+                    return {
+                        'files': files,
+                        'nextFileName': self._names[index],
+                        'nextFileId': file_ids[version_index]
+                    }
+
+                files.append(self.files[file_ids[version_index]].as_dict())
+                version_index += 1
+
+            index += 1
+            version_index = 0
+
+        return {'files': files, 'nextFileName': None, 'nextFileId': None}
+
+
+#Streams a range of the stored data in pieces, without copying the range first
+class FakeResponse(object):
+    def __init__(self, headers, data, start, end):
+        self.headers = headers
+        self._data = data
+        self._start = start
+        self._end = end
+
+    def iter_content(self, chunk_size):
+        for offset in range(self._start, self._end, chunk_size):
+            yield self._data[offset:min(offset + chunk_size, self._end)]
+
+
+#In-process stand-in for B2Http, answering the calls B2RawApi makes from memory. Every
+#request waits for the latency, and data waits for its size over the bandwidth of one
+#connection, outside the lock, so concurrent requests overlap like they do over the network.
+class FakeB2Http(object):
+    def __init__(self, latency=0.0, bandwidth=None):
+        self.latency = latency
+
+        #Bytes per second per connection, None is unlimited
+        self.bandwidth = bandwidth
+
+        self._lock = threading.Lock()
+        self._file_ids = itertools.count()
+
+        #Bucket id -> FakeBucket, buckets are created when first used
+        self._buckets = {}
+
+        #File id -> bucket id
+        self._file_buckets = {}
+
+    def add_file(self, bucket_id, file_name, data, file_info=None):
+        """Stores a file directly, without latency, for setting up benchmarks."""
+        with self._lock:
+            return self._add_file(
+                bucket_id, file_name, data, "application/octet-stream",
+                hashlib.sha1(data).hexdigest(), file_info or {}
+            ).as_dict()
+
+    def _wait(self, length=0):
+        delay = self.latency
+        if self.bandwidth is not None:
+            delay += float(length) / self.bandwidth
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def _raise(self, status, code, message, post_params=None):
+        raise interpret_b2_error(status, code, message, post_params)
+
+    def _get_bucket(self, bucket_id):
+        if bucket_id not in self._buckets:
+            self._buckets[bucket_id] = FakeBucket()
+
+        return self._buckets[bucket_id]
+
+    def _get_file(self, file_id):
+        if file_id not in self._file_buckets:
+            self._raise(404, 'not_found', 'File not present: %s' % file_id)
+
+        return self._buckets[self._file_buckets[file_id]].files[file_id]
+
+    def _add_file(
+        self, bucket_id, file_name, data, content_type, content_sha1, file_info, large=False
+    ):
+        file_id = "4_z%s_f%012d" % (bucket_id, next(self._file_ids))
+        fake_file = FakeFile(
+            bucket_id, file_id, file_name, data, content_type, content_sha1, file_info, large
+        )
+
+        self._get_bucket(bucket_id).add(fake_file)
+        self._file_buckets[file_id] = bucket_id
+
+        return fake_file
+
+    def _remove_file(self, file_id):
+        bucket_id = self._file_buckets.pop(file_id)
+        self._buckets[bucket_id].remove(file_id)
+
+    def _parse_range(self, range_header, length):
+        start, end = range_header[len("bytes="):].split("-")
+        return int(start), min(int(end), length - 1)
+
+    # B2Http interface
+    # ==================
+
+    def post_json_return_json(self, url, headers, params, try_count=1):
+        api_name = url.rsplit("/", 1)[-1]
+
+        self._wait()
+        with self._lock:
+            return getattr(self, "_" + api_name)(**params)
+
+    def post_content_return_json(self, url, headers, data, try_count=1, post_params=None):
+        content = data.read()
+        self._wait(len(content))
+
+        content_sha1 = headers['X-Bz-Content-Sha1']
+        if content_sha1 == HEX_DIGITS_AT_END:
+            content_sha1 = content[-40:].decode()
+            content = content[:-40]
+
+        if hashlib.sha1(content).hexdigest() != content_sha1:
+            self._raise(400, 'bad_request', 'Checksum did not match data received')
+
+        with self._lock:
+            if 'X-Bz-Part-Number' in headers:
+                return self._upload_part(
+                    url.rsplit("/", 1)[-1], int(headers['X-Bz-Part-Number']), content
+                )
+
+            file_info = dict(
+                (key[len('X-Bz-Info-'):], unquote_plus(value))
+                for key, value in headers.items() if key.startswith('X-Bz-Info-')
+            )
+            fake_file = self._add_file(
+                url.rsplit("/", 1)[-1], unquote_plus(headers['X-Bz-File-Name']), content,
+                headers['Content-Type'], content_sha1, file_info
+            )
+            return fake_file.as_dict()
+
+    @contextmanager
+    def get_content(self, url, headers, try_count=1):
+        file_id = url.rsplit("fileId=", 1)[-1]
+
+        with self._lock:
+            fake_file = self._get_file(file_id)
+
+        data = fake_file.data
+        response_headers = {
+            'x-bz-file-id': fake_file.file_id,
+            'x-bz-file-name': fake_file.file_name,
+            'x-bz-content-sha1': fake_file.content_sha1,
+            'x-bz-upload-timestamp': str(fake_file.upload_timestamp),
+            'content-type': fake_file.content_type,
+        }
+        for key, value in fake_file.file_info.items():
+            response_headers['x-bz-info-' + key] = value
+
+        start, end = 0, len(data) - 1
+        if 'Range' in headers:
+            start, end = self._parse_range(headers['Range'], len(data))
+            response_headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(data))
+
+        response_headers['content-length'] = str(end + 1 - start)
+
+        self._wait(end + 1 - start)
+        yield FakeResponse(response_headers, data, start, end + 1)
+
+    # API calls
+    # ==================
+
+    def _b2_authorize_account(self):
+        return {
+            'accountId': ACCOUNT_ID,
+            'authorizationToken': 'fake-token',
+            'apiUrl': API_URL,
+            'downloadUrl': DOWNLOAD_URL,
+            'minimumPartSize': MINIMUM_PART_SIZE,
+        }
+
+    def _b2_list_file_names(self, bucketId, startFileName=None, maxFileCount=None):
+        return self._get_bucket(bucketId).list_file_names(startFileName, maxFileCount or 100)
+
+    def _b2_list_file_versions(
+        self, bucketId, startFileName=None, startFileId=None, maxFileCount=None
+    ):
+        return self._get_bucket(bucketId).list_file_versions(
+            startFileName, startFileId, maxFileCount or 100
+        )
+
+    def _b2_get_file_info(self, fileId):
+        return self._get_file(fileId).as_dict()
+
+    def _b2_delete_file_version(self, fileId, fileName):
+        if fileId not in self._file_buckets or self._get_file(fileId).file_name != fileName:
+            self._raise(
+                400, 'file_not_present', 'File not present: %s' % fileName,
+                {'fileName': fileName}
+            )
+
+        self._remove_file(fileId)
+        return {'fileId': fileId, 'fileName': fileName}
+
+    def _b2_get_upload_url(self, bucketId):
+        upload_url = "%s/b2api/v1/b2_upload_file/%s" % (UPLOAD_URL, bucketId)
+        return {'bucketId': bucketId, 'uploadUrl': upload_url, 'authorizationToken': 'fake-token'}
+
+    def _b2_start_large_file(self, bucketId, fileName, contentType, fileInfo):
+        fake_file = self._add_file(
+            bucketId, fileName, b"", contentType, "none", fileInfo, large=True
+        )
+        return fake_file.as_dict()
+
+    def _b2_get_upload_part_url(self, fileId):
+        upload_url = "%s/b2api/v1/b2_upload_part/%s" % (UPLOAD_URL, fileId)
+        return {'fileId': fileId, 'uploadUrl': upload_url, 'authorizationToken': 'fake-token'}
+
+    def _upload_part(self, file_id, part_number, content):
+        self._get_file(file_id).parts[part_number] = content
+
+        return {
+            'fileId': file_id,
+            'partNumber': part_number,
+            'contentLength': len(content),
+            'contentSha1': hashlib.sha1(content).hexdigest(),
+        }
+
+    def _b2_copy_part(self, sourceFileId, largeFileId, partNumber, range):
+        data = self._get_file(sourceFileId).data
+        start, end = self._parse_range(range, len(data))
+        return self._upload_part(largeFileId, partNumber, data[start:end + 1])
+
+    def _b2_finish_large_file(self, fileId, partSha1Array):
+        fake_file = self._get_file(fileId)
+
+        part_numbers = sorted(fake_file.parts)
+        if part_numbers != list(range(1, len(part_numbers) + 1)):
+            self._raise(
+                400, 'missing_part', 'Missing parts of large file: %s' % fileId,
+                {'fileId': fileId}
+            )
+
+        parts = [fake_file.parts[part_number] for part_number in part_numbers]
+        if [hashlib.sha1(part).hexdigest() for part in parts] != partSha1Array:
+            self._raise(
+                400, 'part_sha1_mismatch', 'Part checksums do not match: %s' % fileId,
+                {'fileId': fileId}
+            )
+
+        bucket = self._buckets[self._file_buckets[fileId]]
+        bucket.remove(fileId)
+
+        fake_file.data = b"".join(parts)
+        fake_file.parts = None
+        bucket.add(fake_file)
+
+        return fake_file.as_dict()
+
+    def _b2_cancel_large_file(self, fileId):
+        fake_file = self._get_file(fileId)
+        self._remove_file(fileId)
+        return {'fileId': fileId, 'fileName': fake_file.file_name}
+
+    def _b2_copy_file(self, sourceFileId, fileName, metadataDirective='COPY'):
+        source = self._get_file(sourceFileId)
+        bucket_id = self._file_buckets[sourceFileId]
+
+        fake_file = self._add_file(
+            bucket_id, fileName, source.data, source.content_type, source.content_sha1,
+            dict(source.file_info)
+        )
+        return fake_file.as_dict()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import threading
+
+
+#State of one file handle. The open file is shared by every handle of its path.
+class FileHandle(object):
+    def __init__(self, path, b2file, read_ahead=None):
+        self.path = path
+        self.b2file = b2file
+
+        #Read pattern of this handle, for files that are read block by block
+        self.read_ahead = read_ahead
+
+
+#Maps file handles to their state and counts the handles of every open file, so a
+#file is only released when its last handle is.
+class HandleTable(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_fh = 0
+        self._handles = {}
+
+        #Open file -> number of handles
+        self._counts = {}
+
+    def __len__(self):
+        return len(self._handles)
+
+    def add(self, path, b2file, read_ahead=None):
+        with self._lock:
+            self._next_fh += 1
+            self._handles[self._next_fh] = FileHandle(path, b2file, read_ahead)
+            self._counts[b2file] = self._counts.get(b2file, 0) + 1
+
+            return self._next_fh
+
+    def get(self, fh):
+        return self._handles.get(fh)
+
+    def count(self, b2file):
+        with self._lock:
+            return self._counts.get(b2file, 0)
+
+    def rename(self, b2file, path):
+        with self._lock:
+            for handle in self._handles.values():
+                if handle.b2file is b2file:
+                    handle.path = path
+
+    def remove(self, fh):
+        #Returns the handle and how many handles its file has left
+        with self._lock:
+            handle = self._handles.pop(fh, None)
+            if handle is None:
+                return None, 0
+
+            remaining = self._counts[handle.b2file] - 1
+            if remaining > 0:
+                self._counts[handle.b2file] = remaining
+            else:
+                del self._counts[handle.b2file]
+
+            return handle, remaining
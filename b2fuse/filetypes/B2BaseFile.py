@@ -23,13 +23,25 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #SOFTWARE.
 
+from concurrent import futures
+
+from b2.download_dest import DownloadDestBytes
+from b2.exception import B2Error, ChecksumMismatch, TruncatedOutput
+
+from ..download_dest import DownloadDestOffset
+
 
 class B2BaseFile(object):
+    #Attempts per part when a large file is downloaded over several connections
+    DOWNLOAD_PART_ATTEMPTS = 5
+
     def __init__(self, b2fuse, file_info):
         self.b2fuse = b2fuse
 
         self.file_info = file_info
 
+        self._dirty = False
+
     def __len__(self):
         raise NotImplemented()
 
@@ -38,3 +50,161 @@ class B2BaseFile(object):
 
     def upload(self):
         raise NotImplemented()
+
+    def is_dirty(self):
+        return self._dirty
+
+    def rename(self, file_info):
+        #Open files follow a rename, later changes are uploaded under the new name
+        self.file_info = file_info
+
+    def _download_bytes(self, range_=None):
+        download_dest = DownloadDestBytes()
+        self.b2fuse.bucket_api.download_file_by_id(
+            self.file_info['fileId'], download_dest, range_=range_
+        )
+        return download_dest.get_bytes_written()
+
+    def _block_ranges(self):
+        block_size = self.b2fuse.block_size
+        size = self.file_info['size']
+
+        return [(offset, min(block_size, size - offset)) for offset in range(0, size, block_size)]
+
+    def _download_range(self, offset, length):
+        #Ranges have to end at byte 1 or later, a block covering the whole file is fetched
+        #without one
+        if offset == 0 and length == self.file_info['size']:
+            return self._download_bytes()
+
+        return self._download_bytes((offset, offset + length - 1))
+
+    def _download_block(self, offset, length):
+        block_cache = self.b2fuse.block_cache
+        if block_cache is not None:
+            data = block_cache.get(self.file_info['fileId'], offset, length)
+            if data is not None:
+                return data
+
+        data = self._download_range(offset, length)
+
+        if block_cache is not None:
+            block_cache.put(self.file_info['fileId'], offset, data)
+
+        return data
+
+    def _expected_sha1(self, file_info=None):
+        #Large files have no content SHA1, but uploaders may record it in the file info
+        if file_info is None:
+            file_info = self.file_info
+
+        content_sha1 = file_info.get('contentSha1')
+        if content_sha1 is not None and content_sha1 != 'none':
+            return content_sha1
+
+        return file_info.get('fileInfo', {}).get('large_file_sha1')
+
+    def _needs_upload(self):
+        #Files written back with the contents B2 already has, like a config file saved
+        #without changes, are not uploaded again. Comparing costs no extra pass, as the
+        #SHA1 of the open file is kept up to date and needed for the upload anyway.
+        size = len(self)
+        stored_info = self.b2fuse._directories.get_file_info(self.file_info['fileName'])
+        if stored_info is None or stored_info.get('size') != size:
+            return True
+
+        expected_sha1 = self._expected_sha1(stored_info)
+        if expected_sha1 is None or self.content_sha1() != expected_sha1:
+            return True
+
+        self.b2fuse.logger.info("Skipping upload of unchanged %s", self.file_info['fileName'])
+        self.b2fuse.metrics.increment("skipped_uploads")
+        self.b2fuse.metrics.increment("skipped_upload_bytes", value=size)
+
+        self.file_info = stored_info
+        return False
+
+    def _download_part(self, offset, length, write_at):
+        file_id = self.file_info['fileId']
+
+        for attempt in range(1, self.DOWNLOAD_PART_ATTEMPTS + 1):
+            download_dest = DownloadDestOffset(write_at, offset)
+            try:
+                self.b2fuse.bucket_api.download_file_by_id(
+                    file_id, download_dest, range_=(offset, offset + length - 1)
+                )
+                if download_dest.bytes_written != length:
+                    raise TruncatedOutput(download_dest.bytes_written, length)
+                return
+            except B2Error as e:
+                if attempt == self.DOWNLOAD_PART_ATTEMPTS or not e.should_retry_http():
+                    raise
+
+                self.b2fuse.logger.warning(
+                    "Retrying part at %s of %s (%s)", offset, self.file_info['fileName'], e
+                )
+
+    def _download_into(self, write_at, content_sha1):
+        #Writes the whole file through write_at(offset, data), large files are fetched
+        #as concurrent ranges and checked against their SHA1 once all parts are in
+        size = self.file_info['size']
+        if size < self.b2fuse.download_threshold:
+            self.b2fuse.bucket_api.download_file_by_id(
+                self.file_info['fileId'], DownloadDestOffset(write_at)
+            )
+            return
+
+        part_size = self.b2fuse.download_part_size
+        part_futures = [
+            self.b2fuse.download_pool.submit(
+                self._download_part, offset, min(part_size, size - offset), write_at
+            ) for offset in range(0, size, part_size)
+        ]
+        futures.wait(part_futures)
+
+        for part_future in part_futures:
+            part_future.result()
+
+        self._check_sha1(content_sha1)
+
+    def _check_sha1(self, content_sha1):
+        expected_sha1 = self._expected_sha1()
+        if expected_sha1 is not None:
+            actual_sha1 = content_sha1()
+            if actual_sha1 != expected_sha1:
+                raise ChecksumMismatch('sha1', expected_sha1, actual_sha1)
+
+    def _download_blocks_into(self, write_at, content_sha1):
+        #Like _download_into, but block by block through the block cache. Blocks are
+        #written as soon as they are in, so at most one block per download thread is
+        #held in memory whatever the size of the file.
+        block_cache = self.b2fuse.block_cache
+        if block_cache is None:
+            self._download_into(write_at, content_sha1)
+            return
+
+        file_id = self.file_info['fileId']
+        downloaded = []
+
+        def fetch_block(offset, length):
+            data = block_cache.get(file_id, offset, length)
+            if data is None:
+                data = self._download_range(offset, length)
+                block_cache.put(file_id, offset, data)
+                downloaded.append(offset)
+
+            write_at(offset, data)
+
+        block_futures = [
+            self.b2fuse.download_pool.submit(fetch_block, offset, length)
+            for offset, length in self._block_ranges()
+        ]
+        futures.wait(block_futures)
+
+        for block_future in block_futures:
+            block_future.result()
+
+        #Cached blocks were checked when they were downloaded
+        if len(downloaded) > 0 and self.file_info['size'] >= self.b2fuse.download_threshold:
+            self._check_sha1(content_sha1)
+
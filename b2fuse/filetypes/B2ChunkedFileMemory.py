@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import tempfile
+import threading
+
+from ..incremental_sha1 import IncrementalSha1
+from ..upload_source import UploadSourceOpenFile
+from .B2BaseFile import B2BaseFile
+
+
+#In-memory file stored as fixed-size chunks. Chunks are allocated on the first write
+#to them, so holes cost no memory, and reads and writes copy through memoryviews.
+#Chunks count against the shared memory budget. Chunks spilled to disk to stay within it
+#are read from there, and brought back into memory when they are written again.
+class B2ChunkedFileMemory(B2BaseFile):
+    CHUNK_SIZE = 1024 * 1024
+
+    _ZERO_CHUNK = memoryview(bytes(CHUNK_SIZE))
+
+    def __init__(self, b2fuse, file_info, new_file=False):
+        super(B2ChunkedFileMemory, self).__init__(b2fuse, file_info)
+
+        self._chunks = {}
+        self._size = 0
+
+        #Chunk indexes whose data is in the spill file
+        self._spilled = set()
+        self._spill_file = None
+
+        self._budget = b2fuse.memory_budget
+
+        self._sha1 = IncrementalSha1()
+
+        #Reentrant, the budget may spill chunks of this file while it is being written
+        self._lock = threading.RLock()
+
+        if new_file:
+            self._dirty = True
+        else:
+            self._download_to_chunks()
+
+    def _download_to_chunks(self):
+        #Parts of a parallel download may share a chunk, writes are serialized by the lock.
+        #Downloaded data is only hashed when the hash is needed.
+        self._download_blocks_into(self._write, self.content_sha1)
+        self._size = self.file_info['size']
+
+    def __len__(self):
+        return self._size
+
+    def content_sha1(self):
+        with self._lock:
+            return self._sha1.hexdigest(self.read, self._size)
+
+    def upload(self):
+        if self._dirty and self._needs_upload():
+            file_info_object = self.b2fuse.bucket_api.upload(
+                UploadSourceOpenFile(self), self.file_info['fileName']
+            )
+            self.file_info = self.b2fuse._add_uploaded_file(file_info_object)
+
+        self._dirty = False
+
+    def _read_spilled(self, chunk_index, chunk_offset, length):
+        self._spill_file.seek(chunk_index * self.CHUNK_SIZE + chunk_offset)
+        return self._spill_file.read(length)
+
+    def _get_chunk_for_write(self, chunk_index):
+        chunk = self._chunks.get(chunk_index)
+        if chunk is not None:
+            self._budget.touch(self, chunk_index)
+            return chunk
+
+        reloaded = chunk_index in self._spilled
+        if reloaded:
+            chunk = bytearray(self._read_spilled(chunk_index, 0, self.CHUNK_SIZE))
+            self._spilled.discard(chunk_index)
+        else:
+            chunk = bytearray(self.CHUNK_SIZE)
+
+        self._chunks[chunk_index] = chunk
+        self._budget.add(self, chunk_index, self.CHUNK_SIZE, reloaded)
+        return chunk
+
+    def spill_chunk(self, chunk_index):
+        #Called by the memory budget, possibly from another thread
+        if not self._lock.acquire(False):
+            return False
+
+        try:
+            chunk = self._chunks.pop(chunk_index, None)
+            if chunk is not None:
+                if self._spill_file is None:
+                    self._spill_file = tempfile.TemporaryFile(dir=self.b2fuse.temp_folder)
+
+                self._spill_file.seek(chunk_index * self.CHUNK_SIZE)
+                self._spill_file.write(chunk)
+                self._spilled.add(chunk_index)
+
+            self._budget.remove(self, chunk_index)
+            return True
+        finally:
+            self._lock.release()
+
+    def _write(self, offset, data):
+        view = memoryview(data)
+        end = offset + len(view)
+
+        with self._lock:
+            position = offset
+            while position < end:
+                chunk_index, chunk_offset = divmod(position, self.CHUNK_SIZE)
+                length = min(self.CHUNK_SIZE - chunk_offset, end - position)
+
+                chunk = self._get_chunk_for_write(chunk_index)
+
+                source = position - offset
+                chunk[chunk_offset:chunk_offset + length] = view[source:source + length]
+                position += length
+
+            self._size = max(self._size, end)
+
+        view.release()
+
+    def write(self, offset, data):
+        with self._lock:
+            self._write(offset, data)
+            self._sha1.update(offset, data)
+
+    def read(self, offset, length):
+        with self._lock:
+            end = min(offset + length, self._size)
+
+            pieces = []
+            position = offset
+            while position < end:
+                chunk_index, chunk_offset = divmod(position, self.CHUNK_SIZE)
+                piece_length = min(self.CHUNK_SIZE - chunk_offset, end - position)
+
+                chunk = self._chunks.get(chunk_index)
+                if chunk is not None:
+                    self._budget.touch(self, chunk_index)
+                    pieces.append(memoryview(chunk)[chunk_offset:chunk_offset + piece_length])
+                elif chunk_index in self._spilled:
+                    pieces.append(self._read_spilled(chunk_index, chunk_offset, piece_length))
+                else:
+                    pieces.append(self._ZERO_CHUNK[:piece_length])
+
+                position += piece_length
+
+            #Joining the views is the only copy of chunks in memory
+            return b''.join(pieces)
+
+    def truncate(self, length):
+        with self._lock:
+            last_chunk = (length - 1) // self.CHUNK_SIZE if length > 0 else -1
+            for chunk_index in [index for index in self._chunks if index > last_chunk]:
+                del self._chunks[chunk_index]
+                self._budget.remove(self, chunk_index)
+
+            for chunk_index in [index for index in self._spilled if index > last_chunk]:
+                self._spilled.discard(chunk_index)
+
+            #Zero the cut off end of the last chunk, so extending the file reads zeros
+            tail = length - last_chunk * self.CHUNK_SIZE
+            if last_chunk in self._chunks or last_chunk in self._spilled:
+                if tail < self.CHUNK_SIZE:
+                    chunk = self._get_chunk_for_write(last_chunk)
+                    chunk[tail:] = self._ZERO_CHUNK[tail:]
+
+            self._size = length
+            self._sha1.rewind(length)
+
+    def set_dirty(self, new_value):
+        self._dirty = new_value
+
+    def delete(self, delete_online):
+        if delete_online:
+            self.b2fuse.bucket_api.delete_file_version(
+                self.file_info['fileId'], self.file_info['fileName']
+            )
+        with self._lock:
+            for chunk_index in self._chunks:
+                self._budget.remove(self, chunk_index)
+
+            self._chunks.clear()
+            self._spilled.clear()
+            self._size = 0
+            self._sha1 = IncrementalSha1()
+
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
@@ -25,9 +25,12 @@
 
 import os
 import os.path
+import tempfile
+import threading
 
-from b2.download_dest import DownloadDestBytes
+from b2.upload_source import UploadSourceLocalFile
 
+from ..incremental_sha1 import IncrementalSha1
 from .B2BaseFile import B2BaseFile
 
 
@@ -35,28 +38,41 @@ class B2FileDisk(B2BaseFile):
     def __init__(self, b2fuse, file_info, new_file=False):
         super(B2FileDisk, self).__init__(b2fuse, file_info)
 
-        self.temp_filename = os.path.join(self.b2fuse.temp_folder, self.file_info['fileName'])
-
-        folder = os.path.join(self.b2fuse.temp_folder, os.path.dirname(self.file_info['fileName']))
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-
         self._dirty = False
 
-        if os.path.exists(self.temp_filename):
-            os.remove(self.temp_filename)
+        self._sha1 = IncrementalSha1()
 
-        self.temp_file = open(self.temp_filename, "r+b")
+        #Not named after the path, a file unlinked while it is still open keeps its
+        #temporary file when a new file is created at the same path
+        fd, self.temp_filename = tempfile.mkstemp(dir=self.b2fuse.temp_folder)
+        self.temp_file = os.fdopen(fd, "w+b")
 
         if new_file:
             self._dirty = True
         else:
-            download_dest = DownloadDestBytes()
-            self.b2fuse.bucket_api.download_file_by_id(self.file_info['fileId'], download_dest)
-            self.temp_file.write(download_dest.get_bytes_written())
+            self._download_to_temp_file()
+
+    def _download_to_temp_file(self):
+        #Downloads go straight to their place in the temporary file, so memory use does
+        #not depend on the file size
+        write_lock = threading.Lock()
+
+        def write_at(offset, data):
+            with write_lock:
+                self.temp_file.seek(offset)
+                self.temp_file.write(data)
+
+        self._download_blocks_into(write_at, self.content_sha1)
+
+        #The size is taken from the file, so nothing may stay in its buffer
+        self.temp_file.flush()
+
+    def content_sha1(self):
+        self.temp_file.flush()
+        return self._sha1.hexdigest(self.read, len(self))
 
     def __len__(self):
-        return os.path.getsize(self.temp_filename)
+        return os.fstat(self.temp_file.fileno()).st_size
 
     def delete(self, delete_online):
         if delete_online:
@@ -70,11 +86,12 @@ class B2FileDisk(B2BaseFile):
     #    self.delete()
 
     def upload(self):
-        if self._dirty:
-            data = self.read(0, len(self))
-            self.b2fuse.bucket_api.upload_bytes(bytes(data), self.file_info['fileName'])
-            self.b2fuse._update_directory_structure()
-            self.file_info = self.b2fuse._directories.get_file_info(self.file_info['fileName'])
+        if self._dirty and self._needs_upload():
+            file_info_object = self.b2fuse.bucket_api.upload(
+                UploadSourceLocalFile(self.temp_filename, self.content_sha1()),
+                self.file_info['fileName']
+            )
+            self.file_info = self.b2fuse._add_uploaded_file(file_info_object)
 
         self._dirty = False
 
@@ -83,6 +100,8 @@ class B2FileDisk(B2BaseFile):
         self.temp_file.write(data)
         self.temp_file.flush()
 
+        self._sha1.update(offset, data)
+
     def read(self, offset, length):
         self.temp_file.seek(offset)
         return self.temp_file.read(length)
@@ -91,5 +110,7 @@ class B2FileDisk(B2BaseFile):
         self.temp_file.seek(0)
         self.temp_file.truncate(length)
 
+        self._sha1.rewind(length)
+
     def set_dirty(self, new_value):
         self._dirty = new_value
@@ -29,8 +29,14 @@ class B2HashFile(B2BaseFile):
     def __init__(self, b2fuse, file_info, new_file=False):
         super(B2HashFile, self).__init__(b2fuse, file_info)
 
-        file_hash = file_info['contentSha1'] + "\n"
-        self.data = bytearray(file_hash.encode("utf-8"))
+        #Files with changes that are not uploaded yet are hashed locally
+        open_file = b2fuse.open_files.get(file_info['fileName'])
+        if open_file is not None and open_file.is_dirty():
+            file_hash = open_file.content_sha1()
+        else:
+            file_hash = self._expected_sha1() or 'none'
+
+        self.data = bytearray((file_hash + "\n").encode("utf-8"))
 
     #def __getitem__(self, key):
     #    if isinstance(key, slice):
@@ -50,4 +56,8 @@ class B2HashFile(B2BaseFile):
         return
 
     def read(self, offset, length):
-        return bytes(self.data)
+        return bytes(self.data[offset:offset + length])
+
+    def delete(self, delete_online):
+        #Hash files are virtual, there is nothing to remove
+        return
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+from collections import OrderedDict
+
+from .B2BaseFile import B2BaseFile
+
+
+#Read-mostly file that only downloads the blocks that are actually read. At most
+#max_blocks blocks are kept per open file. The first write or truncate turns it into
+#a regular file of the configured backend (memory or disk).
+class B2RangedFile(B2BaseFile):
+    def __init__(self, b2fuse, file_info, new_file=False):
+        super(B2RangedFile, self).__init__(b2fuse, file_info)
+
+        self.block_size = self.b2fuse.block_size
+        self.max_blocks = self.b2fuse.max_blocks
+
+        self._blocks = OrderedDict()
+        self._dirty = False
+
+        #Block index -> future of a block that is being read ahead
+        self._prefetching = {}
+
+        #Regular file object used once the file has been modified
+        self._file = None
+
+    def _materialize(self, new_file=False):
+        if self._file is None:
+            self._file = self.b2fuse.B2File(self.b2fuse, self.file_info, new_file)
+            self._file.set_dirty(self._dirty or new_file)
+            self._blocks.clear()
+            self._cancel_prefetching()
+
+        return self._file
+
+    def _cancel_prefetching(self, block_indexes=None):
+        if block_indexes is None:
+            block_indexes = list(self._prefetching)
+
+        for block_index in block_indexes:
+            self._prefetching.pop(block_index).cancel()
+
+    def _get_block(self, block_index):
+        block = self._blocks.pop(block_index, None)
+
+        prefetch = self._prefetching.pop(block_index, None)
+        if block is None and prefetch is not None:
+            try:
+                block = prefetch.result()
+            except Exception as e:
+                self.b2fuse.logger.warning(
+                    "Read-ahead of %s failed (%s)", self.file_info['fileName'], e
+                )
+
+        if block is None:
+            offset = block_index * self.block_size
+            block = self._download_block(offset, min(self.block_size, len(self) - offset))
+
+        self._blocks[block_index] = block
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+        return block
+
+    def __len__(self):
+        if self._file is not None:
+            return len(self._file)
+
+        return self.file_info['size']
+
+    def read(self, offset, length):
+        if self._file is not None:
+            return self._file.read(offset, length)
+
+        end = min(offset + length, len(self))
+        if offset >= end:
+            return b''
+
+        data = []
+        first_block = offset // self.block_size
+        last_block = (end - 1) // self.block_size
+        for block_index in range(first_block, last_block + 1):
+            block = self._get_block(block_index)
+            block_start = block_index * self.block_size
+
+            data.append(block[max(offset - block_start, 0):end - block_start])
+
+        return b''.join(data)
+
+    def prefetch(self, offset, length):
+        #Starts downloading the blocks of the range that are not here yet in the background
+        if self._file is not None:
+            return
+
+        end = min(offset + length, len(self))
+        if offset >= end:
+            return
+
+        first_block = offset // self.block_size
+        last_block = (end - 1) // self.block_size
+
+        #Blocks the reader has already passed will not be read
+        self._cancel_prefetching(
+            [block_index for block_index in self._prefetching if block_index < first_block - 1]
+        )
+
+        for block_index in range(first_block, last_block + 1):
+            if block_index in self._blocks or block_index in self._prefetching:
+                continue
+
+            block_offset = block_index * self.block_size
+            self._prefetching[block_index] = self.b2fuse.download_pool.submit(
+                self._download_block, block_offset, min(self.block_size, len(self) - block_offset)
+            )
+
+    def write(self, offset, data):
+        self._materialize().write(offset, data)
+
+    def truncate(self, length):
+        #Truncating to zero does not need the old content
+        self._materialize(new_file=length == 0).truncate(length)
+
+    def set_dirty(self, new_value):
+        if self._file is not None:
+            self._file.set_dirty(new_value)
+
+        self._dirty = new_value
+
+    def is_dirty(self):
+        return self._file is not None and self._file.is_dirty()
+
+    def content_sha1(self):
+        #Until it is written the file is the version in B2
+        if self._file is not None:
+            return self._file.content_sha1()
+
+        return self._expected_sha1()
+
+    def upload(self):
+        if self._file is not None:
+            self._file.upload()
+            self.file_info = self._file.file_info
+
+    def rename(self, file_info):
+        if self._file is not None:
+            self._file.rename(file_info)
+
+        #Blocks of the old file id may be gone once the rename deletes it
+        self._cancel_prefetching()
+        self.file_info = file_info
+
+    def delete(self, delete_online):
+        if self._file is not None:
+            self._file.delete(delete_online)
+        elif delete_online:
+            self.b2fuse.bucket_api.delete_file_version(
+                self.file_info['fileId'], self.file_info['fileName']
+            )
+
+        self._blocks.clear()
+        self._cancel_prefetching()
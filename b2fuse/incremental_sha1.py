@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import hashlib
+
+
+#SHA1 of a file that is kept up to date as it is written. Sequential writes extend the
+#hash as they come. A write before the hashed end rewinds to the last checkpoint before
+#it, so only the data from there on is read again when the hash is needed.
+class IncrementalSha1(object):
+    CHECKPOINT_SIZE = 16 * 1024 * 1024
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self):
+        #Digest of the first n * CHECKPOINT_SIZE bytes at index n
+        self._checkpoints = [hashlib.sha1()]
+
+        #Digest of the first _hashed bytes
+        self._digest = hashlib.sha1()
+        self._hashed = 0
+
+    def _extend(self, data):
+        view = memoryview(data)
+
+        position = 0
+        while position < len(view):
+            boundary = (self._hashed // self.CHECKPOINT_SIZE + 1) * self.CHECKPOINT_SIZE
+            length = min(len(view) - position, boundary - self._hashed)
+
+            self._digest.update(view[position:position + length])
+            position += length
+            self._hashed += length
+
+            if self._hashed == boundary:
+                self._checkpoints.append(self._digest.copy())
+
+        view.release()
+
+    def rewind(self, offset):
+        #Forgets everything hashed from offset on
+        if offset >= self._hashed:
+            return
+
+        index = offset // self.CHECKPOINT_SIZE
+        del self._checkpoints[index + 1:]
+
+        self._digest = self._checkpoints[index].copy()
+        self._hashed = index * self.CHECKPOINT_SIZE
+
+    def update(self, offset, data):
+        self.rewind(offset)
+
+        #Writes past a gap are picked up when the hash is caught up
+        if offset == self._hashed:
+            self._extend(data)
+
+    def hexdigest(self, read, size):
+        #Catches up with read(offset, length) from the hashed end to size
+        self.rewind(size)
+
+        while self._hashed < size:
+            data = read(self._hashed, min(self.READ_SIZE, size - self._hashed))
+            if len(data) == 0:
+                raise ValueError("File ended at %s while hashing %s bytes" % (self._hashed, size))
+
+            self._extend(data)
+
+        return self._digest.hexdigest()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import functools
+import threading
+
+from contextlib import contextmanager
+
+
+#Lock allowing many readers or a single writer. The writer may re-enter and may also
+#read, but a reader must not try to become a writer.
+class ReadWriteLock(object):
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_count = 0
+
+    def acquire_read(self):
+        with self._condition:
+            if self._writer is threading.current_thread():
+                self._writer_count += 1
+                return
+
+            while self._writer is not None:
+                self._condition.wait()
+
+            self._readers += 1
+
+    def release_read(self):
+        with self._condition:
+            if self._writer is threading.current_thread():
+                self._writer_count -= 1
+                return
+
+            self._readers -= 1
+            if self._readers == 0:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        with self._condition:
+            if self._writer is threading.current_thread():
+                self._writer_count += 1
+                return
+
+            while self._writer is not None or self._readers > 0:
+                self._condition.wait()
+
+            self._writer = threading.current_thread()
+            self._writer_count = 1
+
+    def release_write(self):
+        with self._condition:
+            self._writer_count -= 1
+            if self._writer_count == 0:
+                self._writer = None
+                self._condition.notify_all()
+
+    @contextmanager
+    def read_lock(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_lock(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+#Method decorators for classes keeping a ReadWriteLock in self._lock
+def read_locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.read_lock():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def write_locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.write_lock():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+#Reentrant lock per path. Locks are created on demand and dropped once nobody holds
+#or waits for them. Several paths are always locked in sorted order to avoid deadlocks.
+class PathLocks(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    def _reference(self, path):
+        with self._lock:
+            entry = self._locks.get(path)
+            if entry is None:
+                entry = self._locks[path] = [threading.RLock(), 0]
+
+            entry[1] += 1
+            return entry[0]
+
+    def _dereference(self, path):
+        with self._lock:
+            entry = self._locks[path]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[path]
+
+    @contextmanager
+    def lock(self, *paths):
+        paths = sorted(set(paths))
+        acquired = []
+
+        try:
+            for path in paths:
+                self._reference(path).acquire()
+                acquired.append(path)
+
+            yield
+        finally:
+            for path in reversed(acquired):
+                self._locks[path][0].release()
+                self._dereference(path)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import threading
+
+from collections import OrderedDict
+
+
+#Byte budget shared by the buffers of all open in-memory files. Buffers register their
+#chunks here, and when the total goes over the limit the least recently used chunks are
+#spilled to disk by their owners, whichever file they belong to.
+class MemoryBudget(object):
+    def __init__(self, limit=None):
+        #None is unlimited, chunks are then only counted
+        self.limit = limit
+
+        #(owner, key) -> chunk size, least recently used first
+        self._chunks = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.spills = 0
+        self.reloads = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, owner, key, size, reloaded=False):
+        entry = (owner, key)
+        with self._lock:
+            self._size += size - self._chunks.pop(entry, 0)
+            self._chunks[entry] = size
+
+            if reloaded:
+                self.reloads += 1
+
+        self._spill(entry)
+
+    def touch(self, owner, key):
+        entry = (owner, key)
+        with self._lock:
+            if entry in self._chunks:
+                self._chunks[entry] = self._chunks.pop(entry)
+
+    def remove(self, owner, key):
+        with self._lock:
+            self._size -= self._chunks.pop((owner, key), 0)
+
+    def _spill(self, protected):
+        #Owners are called without the lock held. An owner that is busy in another thread
+        #refuses, and its chunk is passed over rather than waited for.
+        busy = set([protected])
+        while True:
+            with self._lock:
+                if self.limit is None or self._size <= self.limit:
+                    return
+
+                candidate = next((entry for entry in self._chunks if entry not in busy), None)
+
+            if candidate is None:
+                return
+
+            owner, key = candidate
+            if owner.spill_chunk(key):
+                with self._lock:
+                    self.spills += 1
+            else:
+                busy.add(candidate)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import json
+import logging
+import os
+import sqlite3
+
+from contextlib import contextmanager
+
+
+#Last known listing of a bucket in an SQLite database, so a mount can show the tree
+#before the bucket has been listed again
+class MetadataStore(object):
+    def __init__(self, state_folder, bucket_id):
+        self.logger = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
+
+        if not os.path.exists(state_folder):
+            os.makedirs(state_folder)
+
+        self.filename = os.path.join(state_folder, "%s.sqlite" % bucket_id)
+
+        #The snapshot is only a cache, one that cannot be read is started over
+        try:
+            self._create_table()
+        except sqlite3.DatabaseError:
+            self.logger.warning("Metadata snapshot %s is corrupt, replacing it", self.filename)
+            os.remove(self.filename)
+            self._create_table()
+
+    def _create_table(self):
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "file_name TEXT PRIMARY KEY, file_id TEXT, size INTEGER, "
+                "upload_timestamp INTEGER, content_sha1 TEXT, file_info TEXT)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        #A connection per call, so the store can be used from any thread
+        connection = sqlite3.connect(self.filename)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def load(self):
+        try:
+            with self._connect() as connection:
+                rows = connection.execute(
+                    "SELECT file_name, file_id, size, upload_timestamp, content_sha1, file_info "
+                    "FROM files"
+                ).fetchall()
+        except sqlite3.DatabaseError:
+            self.logger.warning("Metadata snapshot is corrupt, ignoring it")
+            return []
+
+        return [
+            {
+                'fileName': file_name,
+                'fileId': file_id,
+                'size': size,
+                'uploadTimestamp': upload_timestamp,
+                'contentSha1': content_sha1,
+                'fileInfo': json.loads(file_info),
+                'action': 'upload'
+            } for file_name, file_id, size, upload_timestamp, content_sha1, file_info in rows
+        ]
+
+    def save(self, file_info_list):
+        rows = [
+            (
+                file_info['fileName'], file_info['fileId'], file_info['size'],
+                file_info['uploadTimestamp'], file_info.get('contentSha1'),
+                json.dumps(file_info.get('fileInfo', {}))
+            ) for file_info in file_info_list
+        ]
+
+        #The snapshot is replaced in a single transaction
+        with self._connect() as connection:
+            connection.execute("DELETE FROM files")
+            connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)", rows)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import bisect
+import threading
+
+from collections import defaultdict
+from contextlib import contextmanager
+from timeit import default_timer
+
+#Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+    5, 10, 30, 60
+)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+
+        #The last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if len(labels) == 0:
+        return ""
+
+    return "{%s}" % ",".join('%s="%s"' % (key, value) for key, value in labels)
+
+
+#Counters and latency histograms, rendered in the Prometheus text format. Recording is
+#a dictionary update under a lock, gauges are only computed when the metrics are read.
+class Metrics(object):
+    def __init__(self, prefix="b2fuse"):
+        self.prefix = prefix
+
+        self._lock = threading.Lock()
+
+        #(name, labels) -> value or Histogram, labels are tuples of (key, value) pairs
+        self._counters = defaultdict(int)
+        self._histograms = {}
+
+        #name -> function returning a value or a list of (labels, value) pairs
+        self._gauges = {}
+
+    def increment(self, name, labels=(), value=1):
+        with self._lock:
+            self._counters[(name, labels)] += value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = Histogram()
+
+            histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name, labels=()):
+        #Records the latency in name_seconds and failures in name_errors
+        start = default_timer()
+        try:
+            yield
+        except Exception:
+            self.increment(name + "_errors", labels)
+            raise
+        finally:
+            self.observe(name + "_seconds", labels, default_timer() - start)
+
+    def register_gauge(self, name, function):
+        self._gauges[name] = function
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, list(histogram.counts), histogram.sum, histogram.count)
+                for key, histogram in self._histograms.items()
+            )
+
+        lines = []
+        typed = set()
+
+        def add_type(name, metric_type):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s %s" % (name, metric_type))
+
+        for (name, labels), value in counters:
+            name = "%s_%s_total" % (self.prefix, name)
+            add_type(name, "counter")
+            lines.append("%s%s %s" % (name, _format_labels(labels), value))
+
+        for (name, labels), counts, total, count in histograms:
+            name = "%s_%s" % (self.prefix, name)
+            add_type(name, "histogram")
+
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf", ), counts):
+                cumulative += bucket_count
+                lines.append(
+                    "%s_bucket%s %s" %
+                    (name, _format_labels(labels, [("le", bound)]), cumulative)
+                )
+            lines.append("%s_sum%s %s" % (name, _format_labels(labels), total))
+            lines.append("%s_count%s %s" % (name, _format_labels(labels), count))
+
+        for name, function in sorted(self._gauges.items()):
+            name = "%s_%s" % (self.prefix, name)
+            add_type(name, "gauge")
+
+            values = function()
+            if not isinstance(values, list):
+                values = [((), values)]
+
+            for labels, value in values:
+                lines.append("%s%s %s" % (name, _format_labels(labels), value))
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,471 @@
+import unittest
+
+import errno
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import threading
+from time import sleep, time
+
+from b2.bucket import Bucket
+from b2.exception import ServiceError
+from fuse import FuseOSError
+from .attribute_cache import AttributeCache
+from .b2fuse_main import B2Fuse
+from .block_cache import BlockCache
+from .cached_bucket import CacheNotFound
+from .fake_b2 import FakeB2Http
+from .filetypes.B2ChunkedFileMemory import B2ChunkedFileMemory
+from .incremental_sha1 import IncrementalSha1
+from .locking import PathLocks
+from .metadata_store import MetadataStore
+from .upload_queue import UploadQueue
+
+BUCKET_ID = "offline"
+
+
+#Runs B2Fuse operations directly against the in-process fake of B2, without FUSE
+class OfflineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._b2_http = FakeB2Http()
+        self._temp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_folder, ignore_errors=True)
+
+    def mount(self, **kwargs):
+        temp_folder = os.path.join(self._temp_folder, "b2fuse")
+        use_disk = kwargs.pop("use_disk", False)
+
+        filesystem = B2Fuse(
+            "offline", "offline", BUCKET_ID, False, temp_folder, use_disk,
+            b2_http=self._b2_http, **kwargs
+        )
+        filesystem("readdir", "/", 0)
+        return filesystem
+
+    def write_file(self, filesystem, path, data):
+        fh = filesystem("create", path, 0o644)
+        filesystem("write", path, data, 0, fh)
+        filesystem("release", path, fh)
+
+    def read_file(self, path):
+        #Through a new mount, so the data comes from the fake of B2
+        with self.mount() as filesystem:
+            fh = filesystem("open", path, os.O_RDONLY)
+            size = filesystem("getattr", path)["st_size"]
+            data = filesystem("read", path, size, 0, fh)
+            filesystem("release", path, fh)
+
+        return data
+
+    def fail_uploads(self):
+        def post_content_return_json(*args, **kwargs):
+            raise ServiceError("503 service unavailable")
+
+        self._b2_http.post_content_return_json = post_content_return_json
+
+    def restore_uploads(self):
+        del self._b2_http.post_content_return_json
+
+
+class TestFailedUploads(OfflineTestCase):
+
+    def check_failed_upload_is_kept(self, use_disk):
+        self.fail_uploads()
+        with self.mount(use_disk=use_disk, write_back=True) as filesystem:
+            self.write_file(filesystem, "/folder/file", b"data")
+
+        filename = os.path.join(filesystem.failed_uploads_folder, "folder", "file")
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), b"data")
+        self.assertFalse(os.path.exists(filesystem.temp_folder))
+
+        #The next mounts neither stop at the leftover folder nor remove it
+        self.restore_uploads()
+        with self.mount(use_disk=use_disk) as filesystem:
+            self.write_file(filesystem, "/other", b"other")
+
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), b"data")
+
+    def test_failed_upload_is_kept_in_memory_mode(self):
+        self.check_failed_upload_is_kept(False)
+
+    def test_failed_upload_is_kept_with_disk(self):
+        self.check_failed_upload_is_kept(True)
+
+
+class TestRmdir(OfflineTestCase):
+
+    def test_removed_folder_is_not_cached(self):
+        self._b2_http.add_file(BUCKET_ID, "folder/file", b"data")
+
+        with self.mount() as filesystem:
+            filesystem("getattr", "/folder")
+            filesystem("getattr", "/folder/file")
+
+            filesystem("rmdir", "/folder")
+
+            for path in ("/folder", "/folder/file"):
+                with self.assertRaises(FuseOSError) as context:
+                    filesystem("getattr", path)
+                self.assertEqual(context.exception.errno, errno.ENOENT)
+
+
+class TestAttributeCache(unittest.TestCase):
+
+    def test_missing_paths_are_bounded(self):
+        cache = AttributeCache(max_missing=3)
+        for index in range(3):
+            cache.update("missing%d" % index, None, cache.generation)
+        cache.update("file", {'st_size': 1}, cache.generation)
+
+        #The least recently used missing path is dropped, files are kept
+        cache.get("missing0")
+        cache.update("missing3", None, cache.generation)
+
+        self.assertEqual(len(cache), 4)
+        self.assertIsNone(cache.get("missing0"))
+        self.assertEqual(cache.get("file"), {'st_size': 1})
+        with self.assertRaises(CacheNotFound):
+            cache.get("missing1")
+
+
+class TestFileContents(OfflineTestCase):
+    CHUNK_SIZE = B2ChunkedFileMemory.CHUNK_SIZE
+
+    def check_random_changes(self, **kwargs):
+        #Writes, some of them past the end, truncates and reads compared against a bytearray
+        rng = random.Random(0)
+        reference = bytearray(os.urandom(2 * self.CHUNK_SIZE + 1000))
+        self._b2_http.add_file(BUCKET_ID, "file", bytes(reference))
+
+        with self.mount(**kwargs) as filesystem:
+            fh = filesystem("open", "/file", os.O_RDWR)
+
+            for _ in range(100):
+                operation = rng.random()
+                if operation < 0.5:
+                    offset = rng.randint(0, len(reference) + self.CHUNK_SIZE)
+                    data = os.urandom(rng.randint(1, 3 * self.CHUNK_SIZE // 2))
+                    filesystem("write", "/file", data, offset, fh)
+
+                    reference.extend(bytes(max(offset - len(reference), 0)))
+                    reference[offset:offset + len(data)] = data
+                elif operation < 0.7:
+                    length = rng.randint(0, len(reference) + self.CHUNK_SIZE)
+                    filesystem("truncate", "/file", length, fh)
+
+                    del reference[length:]
+                    reference.extend(bytes(length - len(reference)))
+                else:
+                    offset = rng.randint(0, len(reference))
+                    length = rng.randint(1, 2 * self.CHUNK_SIZE)
+                    self.assertEqual(
+                        filesystem("read", "/file", length, offset, fh),
+                        bytes(reference[offset:offset + length])
+                    )
+
+                self.assertEqual(filesystem("getattr", "/file")["st_size"], len(reference))
+
+            self.assertEqual(
+                filesystem.open_files["file"].content_sha1(), hashlib.sha1(reference).hexdigest()
+            )
+            filesystem("release", "/file", fh)
+
+        self.assertEqual(self.read_file("/file"), bytes(reference))
+        return filesystem
+
+    def test_random_changes_in_memory(self):
+        self.check_random_changes()
+
+    def test_random_changes_spilled_to_disk(self):
+        filesystem = self.check_random_changes(memory_limit=2 * self.CHUNK_SIZE)
+        self.assertGreater(filesystem.memory_budget.spills, 0)
+        self.assertGreater(filesystem.memory_budget.reloads, 0)
+
+    def test_random_changes_with_disk(self):
+        self.check_random_changes(use_disk=True)
+
+    def test_hole_reads_as_zeros(self):
+        with self.mount() as filesystem:
+            fh = filesystem("create", "/file", 0o644)
+            filesystem("write", "/file", b"end", 3 * self.CHUNK_SIZE, fh)
+
+            data = filesystem("read", "/file", 4 * self.CHUNK_SIZE, 0, fh)
+            self.assertEqual(data, bytes(3 * self.CHUNK_SIZE) + b"end")
+
+            #Only the written chunk takes memory
+            self.assertEqual(len(filesystem.memory_budget), self.CHUNK_SIZE)
+            filesystem("release", "/file", fh)
+
+
+class TestListingPatches(OfflineTestCase):
+    LISTINGS = [("", False), ("", True), ("b", False), ("b", True), ("b/d", False)]
+
+    def listing(self, entries):
+        #Folders are compared by name, the file that stands for them may differ
+        return [
+            (file_version_info.file_name, file_version_info.id_, file_version_info.size)
+            if folder_name is None else folder_name
+            for file_version_info, folder_name in entries
+        ]
+
+    def check_listings(self, filesystem):
+        bucket_api = filesystem.bucket_api
+        for folder_to_list, recursive in self.LISTINGS:
+            fresh = Bucket.ls(bucket_api, folder_to_list, recursive=recursive)
+            self.assertEqual(
+                self.listing(bucket_api.ls(folder_to_list, recursive)), self.listing(fresh),
+                "Listing of %r (recursive %s) differs" % (folder_to_list, recursive)
+            )
+
+    def test_patched_listings_match_fresh_listings(self):
+        for file_name in ("a", "b/c", "b/d/e", "f/g"):
+            self._b2_http.add_file(BUCKET_ID, file_name, b"data")
+
+        with self.mount() as filesystem:
+            self.check_listings(filesystem)
+            misses = filesystem.bucket_api.get_cache_stats()['misses']
+
+            for path in ("/a", "/b/0", "/b/d/f", "/new/file"):
+                self.write_file(filesystem, path, b"new data")
+                self.check_listings(filesystem)
+
+            #Uploads patch every listing rather than having it fetched again
+            self.assertEqual(filesystem.bucket_api.get_cache_stats()['misses'], misses)
+
+            filesystem("unlink", "/b/c")
+            self.check_listings(filesystem)
+
+            filesystem("rename", "/f/g", "/b/h")
+            self.check_listings(filesystem)
+
+            filesystem("rename", "/b/d", "/b/moved")
+            self.check_listings(filesystem)
+
+
+class TestBlockCache(unittest.TestCase):
+
+    def setUp(self):
+        self._cache_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._cache_folder, ignore_errors=True)
+
+    def test_least_recently_used_blocks_are_evicted(self):
+        cache = BlockCache(self._cache_folder, 30)
+        for offset in (0, 10, 20):
+            cache.put("file", offset, os.urandom(10))
+
+        cache.get("file", 0, 10)
+        cache.put("file", 30, os.urandom(10))
+
+        self.assertEqual(len(cache), 30)
+        self.assertIsNone(cache.get("file", 10, 10))
+        for offset in (0, 20, 30):
+            self.assertIsNotNone(cache.get("file", offset, 10))
+
+    def test_blocks_are_reused_by_the_next_mount(self):
+        cache = BlockCache(self._cache_folder, 30)
+        blocks = dict((offset, os.urandom(10)) for offset in (0, 10, 20))
+        for offset, data in blocks.items():
+            cache.put("file", offset, data)
+        cache.get("file", 0, 10)
+        cache.close()
+
+        cache = BlockCache(self._cache_folder, 30)
+        for offset, data in blocks.items():
+            self.assertEqual(cache.get("file", offset, 10), data)
+
+        #The order of use is kept with the blocks, so the block read last is evicted last
+        cache = BlockCache(self._cache_folder, 20)
+        self.assertIsNone(cache.get("file", 10, 10))
+        self.assertEqual(cache.get("file", 0, 10), blocks[0])
+
+    def test_blocks_of_another_size_are_not_returned(self):
+        cache = BlockCache(self._cache_folder, 30)
+        cache.put("file", 0, os.urandom(10))
+
+        self.assertIsNone(cache.get("file", 0, 5))
+
+        cache.discard("file")
+        self.assertIsNone(cache.get("file", 0, 10))
+        self.assertEqual(len(cache), 0)
+
+
+class TestIncrementalSha1(unittest.TestCase):
+
+    def setUp(self):
+        self._sha1 = IncrementalSha1()
+        self._sha1.CHECKPOINT_SIZE = 4
+        self._sha1.READ_SIZE = 3
+
+        self._data = bytearray()
+        self._reads = []
+
+    def read(self, offset, length):
+        self._reads.append((offset, length))
+        return bytes(self._data[offset:offset + length])
+
+    def write(self, offset, data):
+        if offset > len(self._data):
+            self._data.extend(bytes(offset - len(self._data)))
+        self._data[offset:offset + len(data)] = data
+
+        self._sha1.update(offset, data)
+
+    def truncate(self, length):
+        del self._data[length:]
+        self._data.extend(bytes(length - len(self._data)))
+
+        self._sha1.rewind(length)
+
+    def hexdigest(self):
+        return self._sha1.hexdigest(self.read, len(self._data))
+
+    def test_sequential_writes_are_not_read_again(self):
+        for offset in range(0, 40, 7):
+            self.write(offset, os.urandom(7))
+
+        self.assertEqual(self.hexdigest(), hashlib.sha1(self._data).hexdigest())
+        self.assertEqual(self._reads, [])
+
+    def test_rewrite_reads_from_the_last_checkpoint(self):
+        self.write(0, os.urandom(40))
+        self.write(37, b"x")
+
+        self.assertEqual(self.hexdigest(), hashlib.sha1(self._data).hexdigest())
+        self.assertEqual(self._reads, [(36, 3), (39, 1)])
+
+    def test_random_changes(self):
+        rng = random.Random(0)
+        for _ in range(1000):
+            operation = rng.random()
+            if operation < 0.6:
+                self.write(rng.randint(0, len(self._data) + 8), os.urandom(rng.randint(1, 10)))
+            elif operation < 0.8:
+                self.truncate(rng.randint(0, len(self._data) + 8))
+            else:
+                self.assertEqual(self.hexdigest(), hashlib.sha1(self._data).hexdigest())
+
+
+class UploadQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._uploads = []
+        self._uploaded = threading.Event()
+
+    def upload_file(self, path, b2file):
+        self._uploads.append((path, b2file, time()))
+        self._uploaded.set()
+
+    def make_queue(self, delay=0):
+        return UploadQueue(self.upload_file, PathLocks(), 2, 4, delay)
+
+
+class TestUploadDelay(UploadQueueTestCase):
+
+    def test_repeated_releases_are_uploaded_once(self):
+        queue = self.make_queue(0.2)
+        b2file = object()
+
+        start = time()
+        for _ in range(3):
+            queue.submit("file", b2file)
+            sleep(0.05)
+
+        self.assertTrue(self._uploaded.wait(5))
+        queue.close()
+
+        self.assertEqual([path for path, _, _ in self._uploads], ["file"])
+        self.assertEqual(queue.coalesced, 2)
+
+        #The wait starts over with every release
+        self.assertGreaterEqual(self._uploads[0][2] - start, 0.1 + 0.2)
+
+    def test_close_uploads_waiting_files(self):
+        queue = self.make_queue(60)
+        queue.submit("file", object())
+        queue.close()
+
+        self.assertEqual(len(self._uploads), 1)
+        self.assertEqual(len(queue), 0)
+
+    def test_cancelled_files_are_not_uploaded(self):
+        queue = self.make_queue(60)
+        b2file = object()
+        queue.submit("file", b2file)
+        queue.cancel(b2file)
+        queue.close()
+
+        self.assertEqual(self._uploads, [])
+
+
+class TestUploadRetries(UploadQueueTestCase):
+
+    def setUp(self):
+        super(TestUploadRetries, self).setUp()
+        self._failures = 2
+
+    def upload_file(self, path, b2file):
+        if self._failures > 0:
+            self._failures -= 1
+            raise ServiceError("503 service unavailable")
+
+        super(TestUploadRetries, self).upload_file(path, b2file)
+
+    def make_queue(self, delay=0):
+        queue = super(TestUploadRetries, self).make_queue(delay)
+        queue.RETRY_DELAY = 0.05
+        return queue
+
+    def test_failed_uploads_are_retried_with_backoff(self):
+        queue = self.make_queue()
+
+        start = time()
+        queue.submit("file", object())
+        self.assertEqual(len(queue), 1)
+
+        self.assertTrue(self._uploaded.wait(5))
+        queue.close()
+
+        #Retried after 0.05 and then 0.1 seconds
+        self.assertEqual(len(self._uploads), 1)
+        self.assertGreaterEqual(self._uploads[0][2] - start, 0.15)
+        self.assertEqual(len(queue), 0)
+
+    def test_close_stops_retrying(self):
+        self._failures = 1000
+        queue = self.make_queue()
+        queue.submit("file", object())
+        queue.close()
+
+        self.assertEqual(self._uploads, [])
+
+
+class TestMetadataStore(OfflineTestCase):
+
+    def test_corrupt_snapshot_is_replaced(self):
+        state_folder = os.path.join(self._temp_folder, "state")
+        os.makedirs(state_folder)
+        with open(os.path.join(state_folder, "%s.sqlite" % BUCKET_ID), "wb") as f:
+            f.write(b"not a database" * 100)
+
+        self._b2_http.add_file(BUCKET_ID, "file", b"data")
+        with self.mount(state_folder=state_folder) as filesystem:
+            self.assertEqual(filesystem("getattr", "/file")["st_size"], 4)
+
+        #The snapshot saved at unmount is loaded by the next mount
+        self.assertEqual(
+            [file_info['fileName'] for file_info in MetadataStore(state_folder, BUCKET_ID).load()],
+            ["file"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
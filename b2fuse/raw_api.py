@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+from contextlib import contextmanager
+
+from b2.download_dest import AbstractDownloadDestination
+from b2.raw_api import B2RawApi
+
+
+#Passes a download on to another destination, counting the bytes written
+class CountingDownloadDest(AbstractDownloadDestination):
+    def __init__(self, download_dest, count):
+        self.download_dest = download_dest
+        self.count = count
+
+    @contextmanager
+    def make_file_context(self, *args, **kwargs):
+        with self.download_dest.make_file_context(*args, **kwargs) as f:
+            yield CountingWriter(f, self.count)
+
+
+class CountingWriter(object):
+    def __init__(self, f, count):
+        self._f = f
+        self._count = count
+
+    def write(self, data):
+        self._f.write(data)
+        self._count(len(data))
+
+
+#Raw API with the server-side copy calls, which only exist in version 2 of the B2 API.
+#With metrics every call is counted and timed, and transferred bytes are counted.
+class B2FuseRawApi(B2RawApi):
+    def __init__(self, b2_http, metrics=None):
+        super(B2FuseRawApi, self).__init__(b2_http)
+        self.metrics = metrics
+
+    @contextmanager
+    def _timed(self, api_name):
+        if self.metrics is None:
+            yield
+            return
+
+        self.metrics.increment("b2_calls", (("call", api_name), ))
+        with self.metrics.timed("b2_call", (("call", api_name), )):
+            yield
+
+    def _count_bytes(self, direction, length):
+        if self.metrics is not None:
+            self.metrics.increment("b2_bytes", (("direction", direction), ), length)
+
+    def _post_json(self, base_url, api_name, auth, **params):
+        with self._timed(api_name):
+            return super(B2FuseRawApi, self)._post_json(base_url, api_name, auth, **params)
+
+    def _post_json_v2(self, base_url, api_name, auth, **params):
+        url = base_url + '/b2api/v2/' + api_name
+        headers = {'Authorization': auth}
+        with self._timed(api_name):
+            return self.b2_http.post_json_return_json(url, headers, params)
+
+    def download_file_by_id(
+        self, download_url, account_auth_token_or_none, file_id, download_dest, range_=None
+    ):
+        download_dest = CountingDownloadDest(
+            download_dest, lambda length: self._count_bytes("download", length)
+        )
+        with self._timed('b2_download_file_by_id'):
+            return super(B2FuseRawApi, self).download_file_by_id(
+                download_url, account_auth_token_or_none, file_id, download_dest, range_=range_
+            )
+
+    def upload_file(
+        self, upload_url, upload_auth_token, file_name, content_length, content_type, content_sha1,
+        file_infos, data_stream
+    ):
+        with self._timed('b2_upload_file'):
+            result = super(B2FuseRawApi, self).upload_file(
+                upload_url, upload_auth_token, file_name, content_length, content_type,
+                content_sha1, file_infos, data_stream
+            )
+
+        self._count_bytes("upload", content_length)
+        return result
+
+    def upload_part(
+        self, upload_url, upload_auth_token, part_number, content_length, content_sha1, data_stream
+    ):
+        with self._timed('b2_upload_part'):
+            result = super(B2FuseRawApi, self).upload_part(
+                upload_url, upload_auth_token, part_number, content_length, content_sha1,
+                data_stream
+            )
+
+        self._count_bytes("upload", content_length)
+        return result
+
+    def copy_file(self, api_url, account_auth_token, source_file_id, new_file_name):
+        return self._post_json_v2(
+            api_url,
+            'b2_copy_file',
+            account_auth_token,
+            sourceFileId=source_file_id,
+            fileName=new_file_name,
+            metadataDirective='COPY'
+        )
+
+    def copy_part(
+        self, api_url, account_auth_token, source_file_id, large_file_id, part_number, range_
+    ):
+        return self._post_json_v2(
+            api_url,
+            'b2_copy_part',
+            account_auth_token,
+            sourceFileId=source_file_id,
+            largeFileId=large_file_id,
+            partNumber=part_number,
+            range='bytes=%d-%d' % range_
+        )
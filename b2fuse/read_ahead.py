@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+#Tracks the reads of one file handle. Sequential reads double the read-ahead window up
+#to max_window, any other read closes it, like the kernel readahead.
+class ReadAhead(object):
+    def __init__(self, min_window, max_window):
+        self.min_window = min_window
+        self.max_window = max_window
+
+        #Reading from the start of a file counts as sequential
+        self._next_offset = 0
+        self.window = 0
+
+    def record(self, offset, length):
+        #Returns how many bytes after this read should be fetched ahead
+        if offset == self._next_offset:
+            self.window = min(max(self.window * 2, self.min_window), self.max_window)
+        else:
+            self.window = 0
+
+        self._next_offset = offset + length
+        return self.window
@@ -12,14 +12,19 @@ def init_b2fuse():
 
     os.makedirs("mountpoint")
 
+    #In MB, like on the command line
+    memory_limit = config.get("memoryLimit")
+    if memory_limit is not None:
+        memory_limit *= 1024 * 1024
+
     filesystem = B2Fuse(
         config["accountId"],
         config["applicationKey"],
         config["bucketId"],
-        config["enableHashfiles"],
-        config["memoryLimit"],
-        config["tempFolder"],
-        config["useDisk"],
+        config.get("enableHashfiles", False),
+        config.get("tempFolder", ".tmp/"),
+        config.get("useDisk", False),
+        memory_limit=memory_limit,
     )
 
     fuse = FUSE(filesystem, "mountpoint", nothreads=True, foreground=False)
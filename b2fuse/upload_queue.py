@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import logging
+import threading
+
+from concurrent import futures
+from time import time
+
+
+#Uploads released files in the background. A file waits in the queue until it is
+#uploaded, reopened or deleted, at most max_pending files are scheduled at a time.
+#With a delay a file is only uploaded once it has not been released again for that
+#many seconds, so files that are rewritten over and over are uploaded once. Failed
+#uploads are retried with exponential backoff until the queue is closed.
+class UploadQueue(object):
+    #Seconds before the first retry of a failed upload, doubled for every further one
+    RETRY_DELAY = 1
+    MAX_RETRY_DELAY = 60
+
+    def __init__(self, upload_file, path_locks, threads, max_pending, delay=0):
+        self.logger = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
+
+        #Called as upload_file(path, b2file) with the path locked
+        self._upload_file = upload_file
+        self._path_locks = path_locks
+
+        self._pool = futures.ThreadPoolExecutor(max_workers=threads)
+
+        #A release holding one or two path locks may wait for a slot, while at most one
+        #scheduled upload per locked path waits for that release, so keep at least three
+        self._slots = threading.BoundedSemaphore(max(max_pending, 3))
+
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._scheduled = set()
+
+        #Releases of files that were already scheduled, each one an upload saved
+        self.coalesced = 0
+
+        #b2file -> (path, time it is due, failed attempts), for scheduled files that are
+        #waiting for their delay or for a retry
+        self.delay = delay
+        self._delayed = {}
+        self._closed = False
+        self._wakeup = threading.Condition(self._lock)
+
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def submit(self, path, b2file):
+        with self._lock:
+            self._pending.add(b2file)
+            if b2file in self._scheduled:
+                self.coalesced += 1
+
+                #Releasing the file again starts its wait over
+                if b2file in self._delayed:
+                    self._delayed[b2file] = (path, time() + self.delay, 0)
+                return
+
+            self._scheduled.add(b2file)
+
+        self._slots.acquire()
+
+        if self.delay > 0:
+            with self._wakeup:
+                self._delayed[b2file] = (path, time() + self.delay, 0)
+                self._wakeup.notify()
+        else:
+            self._pool.submit(self._run, path, b2file, 0)
+
+        self.logger.info("Queued upload of %s (%s pending)", path, len(self))
+
+    def _dispatch(self):
+        #Hands delayed files to the upload threads when they are due, all of them at once
+        #when the queue is closed
+        with self._wakeup:
+            while True:
+                now = time()
+                for b2file, (path, due, attempts) in list(self._delayed.items()):
+                    if due <= now or self._closed:
+                        del self._delayed[b2file]
+                        self._pool.submit(self._run, path, b2file, attempts)
+
+                if self._closed:
+                    return
+
+                if len(self._delayed) > 0:
+                    self._wakeup.wait(min(due for _, due, _ in self._delayed.values()) - now)
+                else:
+                    self._wakeup.wait()
+
+    def cancel(self, b2file):
+        with self._lock:
+            self._pending.discard(b2file)
+
+    def _take(self, b2file):
+        with self._lock:
+            self._scheduled.discard(b2file)
+            if b2file not in self._pending:
+                return False
+
+            self._pending.remove(b2file)
+            return True
+
+    def _retry(self, path, b2file, attempts):
+        #Called with the path locked, so the file cannot have been reopened since it failed.
+        #A retried file keeps its slot.
+        with self._wakeup:
+            if self._closed:
+                return False
+
+            retry_delay = min(self.RETRY_DELAY * 2 ** attempts, self.MAX_RETRY_DELAY)
+            self._pending.add(b2file)
+            self._scheduled.add(b2file)
+            self._delayed[b2file] = (path, time() + retry_delay, attempts + 1)
+            self._wakeup.notify()
+
+        self.logger.warning("Retrying upload of %s in %s seconds", path, retry_delay)
+        return True
+
+    def _run(self, path, b2file, attempts):
+        retrying = False
+        try:
+            #Skip files cancelled while waiting without contending for their path
+            with self._lock:
+                if b2file not in self._pending:
+                    self._scheduled.discard(b2file)
+                    return
+
+            with self._path_locks.lock(path):
+                if not self._take(b2file):
+                    return
+
+                try:
+                    self._upload_file(path, b2file)
+                except Exception:
+                    retrying = self._retry(path, b2file, attempts)
+                    raise
+
+            self.logger.info("Uploaded %s (%s pending)", path, len(self))
+        except Exception:
+            self.logger.exception("Background upload of %s failed", path)
+        finally:
+            if not retrying:
+                self._slots.release()
+
+    def close(self):
+        #Uploads waiting files right away and waits for every queued upload to finish.
+        #Files that still fail are left to the caller.
+        with self._wakeup:
+            self._closed = True
+            self._wakeup.notify()
+
+        self._dispatcher.join()
+        self._pool.shutdown(wait=True)
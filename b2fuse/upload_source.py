@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#The MIT License (MIT)
+
+#Copyright (c) 2015 Sondre Engebraaten
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+from b2.upload_source import AbstractUploadSource
+
+
+#Read-only file-like object over an open file (anything with read(offset, length) and len())
+class OpenFileReader(object):
+    def __init__(self, b2file):
+        self._b2file = b2file
+        self._position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self._position
+        elif whence == 2:
+            position += len(self._b2file)
+
+        self._position = position
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=None):
+        if size is None or size < 0:
+            size = len(self._b2file) - self._position
+
+        data = self._b2file.read(self._position, size)
+        self._position += len(data)
+        return data
+
+    def close(self):
+        return
+
+
+#Uploads an open file piece by piece, so the upload does not need a flat copy of it.
+#The file keeps its own running SHA1, so it is not read an extra time for the hash.
+class UploadSourceOpenFile(AbstractUploadSource):
+    def __init__(self, b2file):
+        self.b2file = b2file
+
+    def get_content_length(self):
+        return len(self.b2file)
+
+    def get_content_sha1(self):
+        return self.b2file.content_sha1()
+
+    def open(self):
+        return OpenFileReader(self.b2file)